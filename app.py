@@ -1,7 +1,13 @@
+import pandas as pd
 import streamlit as st
 import config
+from telemetry import RunTelemetry, format_summary
+from balancer import PoolMember, build_pool, load_pool_spec
+from providers import get_chat_provider, get_embedding_provider
 from improvement5 import run_improvement5
-from improvement4 import generate_chunk_embeddings
+from improvement4 import generate_chunk_embeddings, export_embeddings_npz, export_embeddings_parquet
+from jobs import ACTIVE_STATES, DONE, get_job_manager, jobs_exist
+from vector_index import VectorIndex, hits_to_frame, load_npz_index
 
 st.set_page_config(page_title="Chapter & Chunk Enricher", layout="wide")
 st.title("📑 Chapter & Chunk Enricher")
@@ -26,34 +32,239 @@ EMBED_MODELS = {
 chat_choice  = st.selectbox("🤖 Choose Chat Model",      list(CHAT_MODELS.keys()))
 embed_choice = st.selectbox("🔎 Choose Embedding Model", list(EMBED_MODELS.keys()))
 
+max_concurrency = st.slider(
+    "⚡ Concurrent API requests", min_value=1, max_value=32,
+    value=config.MAX_CONCURRENT_REQUESTS,
+    help="How many chunk prompts are sent to the provider at the same time."
+)
+pack_chunks = st.checkbox(
+    "📦 Pack several chunks per request",
+    help="Sends consecutive chunks together (bounded by a token budget) to cut request count."
+)
+stream_responses = st.checkbox(
+    "📡 Stream responses",
+    value=config.STREAMING,
+    help="Streams each answer and shows enriched chunks in a live table as they are parsed. "
+         "Stalled streams are noticed after a few seconds instead of the full request timeout."
+)
+try:
+    pool_entries = load_pool_spec()
+except ValueError as e:
+    st.error(f"❌ {e}. The provider pool is disabled.")
+    pool_entries = []
+use_pool = bool(pool_entries) and st.checkbox(
+    f"⚖️ Load-balance across the provider pool ({len(pool_entries)} configured + this key)",
+    help="Spreads chunk prompts over PROVIDER_POOL members by weight, honouring their rate limits, "
+         "and fails over when one errors."
+)
+run_in_background = st.checkbox(
+    "🗂️ Run as background jobs",
+    help="Queues enrichment/embedding runs in worker processes. They keep going while you use the app, "
+         "several books run in parallel, and results are saved under the jobs folder."
+)
+
 st.markdown(f"**Using Chat:** {chat_choice}  \n**Embedding:** {embed_choice}")
 
 chat_model, chat_url   = CHAT_MODELS[chat_choice]
 embed_model, embed_url = EMBED_MODELS[embed_choice]
 
+
+def render_run_report(telemetry, name):
+    """Summary line plus JSON/CSV downloads of a run's per-call telemetry."""
+    st.caption(f"📈 {format_summary(telemetry.summary())}")
+    col_json, col_csv = st.columns(2)
+    col_json.download_button(
+        "⬇️ Run report (JSON)", telemetry.to_json().encode("utf-8"),
+        file_name=f"{name}_run_report.json", mime="application/json", key=f"{name}_report_json"
+    )
+    col_csv.download_button(
+        "⬇️ Per-call metrics (CSV)", telemetry.to_csv().encode("utf-8"),
+        file_name=f"{name}_calls.csv", mime="text/csv", key=f"{name}_report_csv"
+    )
+
+
 # 3) Enrichment
 st.header("🚀 Enrich Chapters & Chunks")
 file1 = st.file_uploader("Upload CSV with 'Detected Title' & 'TEXT CHUNK'", key="step1", type="csv")
-if file1 and st.button("Start Enrichment"):
-    df1 = run_improvement5(file1, chat_model, chat_url, api_key)
-    if df1 is not None:
-        st.download_button(
-            "⬇️ Download Enriched CSV",
-            df1.to_csv(index=False).encode("utf-8"),
-            file_name="enriched_chapters_chunks.csv",
-            mime="text/csv"
-        )
+if file1 and run_in_background and st.button("Queue Enrichment Job"):
+    job_id = get_job_manager().submit(
+        "enrichment", file1.getvalue(), file1.name, api_key,
+        model_name=chat_model, api_url=chat_url, label=chat_choice,
+        max_concurrency=max_concurrency, pack_chunks=pack_chunks, use_pool=use_pool, stream=stream_responses,
+    )
+    st.success(f"✅ Queued enrichment job {job_id}; follow it under Background Jobs.")
+elif file1 and not run_in_background and st.button("Start Enrichment"):
+    pool = None
+    if use_pool:
+        own_member = PoolMember(get_chat_provider(chat_model, chat_url, api_key), label=chat_choice)
+        pool = build_pool(pool_entries, [own_member])
+        st.info(f"⚖️ Provider pool: {', '.join(m.label for m in pool.members)}")
+    telemetry1 = RunTelemetry(label="Provider pool" if pool else f"{chat_choice} ({chat_model})")
+    df1 = run_improvement5(
+        file1, pool.model_name if pool else chat_model, pool.api_url if pool else chat_url, api_key,
+        max_concurrency, pack_chunks, telemetry=telemetry1, provider=pool, stream=stream_responses
+    )
+    if pool:
+        st.dataframe(pool.status())
+    # Kept in session state so the results survive the rerun triggered by a download click;
+    # serialized once here rather than on every rerun.
+    st.session_state["enrichment_result"] = (
+        (df1.to_csv(index=False).encode("utf-8"), telemetry1) if df1 is not None else None
+    )
+
+if st.session_state.get("enrichment_result"):
+    csv_bytes1, telemetry1 = st.session_state["enrichment_result"]
+    st.download_button(
+        "⬇️ Download Enriched CSV",
+        csv_bytes1,
+        file_name="enriched_chapters_chunks.csv",
+        mime="text/csv"
+    )
+    render_run_report(telemetry1, "enrichment")
 
 # 4) Embeddings
 st.markdown("---")
 st.header("🔗 Generate Chunk Embeddings")
 file2 = st.file_uploader("Upload enriched CSV", key="step2", type="csv")
-if file2 and st.button("Generate Embeddings"):
-    df2 = generate_chunk_embeddings(file2, embed_model, embed_url, api_key)
-    if df2 is not None:
+if file2 and run_in_background and st.button("Queue Embeddings Job"):
+    job_id = get_job_manager().submit(
+        "embeddings", file2.getvalue(), file2.name, api_key,
+        model_name=embed_model, api_url=embed_url, label=embed_choice,
+    )
+    st.success(f"✅ Queued embeddings job {job_id}; follow it under Background Jobs.")
+elif file2 and not run_in_background and st.button("Generate Embeddings"):
+    telemetry2 = RunTelemetry(label=f"{embed_choice} ({embed_model})")
+    df2, row_ids, matrix = generate_chunk_embeddings(
+        file2, embed_model, embed_url, api_key, return_matrix=True, telemetry=telemetry2
+    )
+    # Kept in session state so the results survive the rerun triggered by a download click
+    # (and search keystrokes); the downloads are serialized once here, Parquet on first use.
+    st.session_state["embeddings_result"] = (df2, row_ids, matrix, telemetry2, {
+        "csv": df2.to_csv(index=False).encode("utf-8"),
+        "npz": export_embeddings_npz(row_ids, matrix),
+    }) if df2 is not None else None
+
+if st.session_state.get("embeddings_result"):
+    df2, row_ids, matrix, telemetry2, exports = st.session_state["embeddings_result"]
+    st.download_button(
+        "⬇️ Download Embeddings CSV",
+        exports["csv"],
+        file_name="chunks_with_embeddings.csv",
+        mime="text/csv"
+    )
+    binary_format = st.radio(
+        "Binary embeddings format", ["NumPy (.npz)", "Parquet"], horizontal=True,
+        help="float32 matrix plus the CSV row id of every vector."
+    )
+    if binary_format == "Parquet":
+        if "parquet" not in exports:
+            try:
+                exports["parquet"] = export_embeddings_parquet(row_ids, matrix)
+            except ImportError:
+                st.warning("⚠️ Parquet export needs the optional 'pyarrow' package (pip install pyarrow).")
+        binary_data = exports.get("parquet")
+        file_name, mime = "chunk_embeddings.parquet", "application/octet-stream"
+    else:
+        binary_data = exports["npz"]
+        file_name, mime = "chunk_embeddings.npz", "application/octet-stream"
+    if binary_data is not None:
         st.download_button(
-            "⬇️ Download Embeddings CSV",
-            df2.to_csv(index=False).encode("utf-8"),
-            file_name="chunks_with_embeddings.csv",
-            mime="text/csv"
+            f"⬇️ Download Binary Embeddings ({matrix.shape[0]} × {matrix.shape[1] if matrix.ndim == 2 else 0} float32)",
+            binary_data,
+            file_name=file_name,
+            mime=mime
         )
+    render_run_report(telemetry2, "embeddings")
+
+# 5) Background jobs
+# The manager (jobs folder + worker pool) is only created once jobs are used.
+if run_in_background or jobs_exist():
+    st.markdown("---")
+    st.header("🗂️ Background Jobs")
+    manager = get_job_manager()
+    st.button("🔄 Refresh status")
+    for job in manager.list_jobs():
+        job_id, state = job["job_id"], job["state"]
+        with st.expander(f"{job.get('name', '')} · {job.get('kind', '')} · {state} ({job_id})",
+                         expanded=state in ACTIVE_STATES):
+            progress_text = f"{job.get('rows_done', 0)} rows done"
+            if job.get("rows_total"):
+                progress_text += f" of {job['rows_total']}"
+            if job.get("batches_total"):
+                progress_text += f" · batch {job.get('batches_done', 0)}/{job['batches_total']}"
+            st.write(progress_text)
+            if job.get("summary"):
+                st.caption(f"📈 {format_summary(job['summary'])}")
+            if job.get("message"):
+                st.caption(job["message"])
+
+            col_action, col_output, col_extra = st.columns(3)
+            if state in ACTIVE_STATES:
+                if col_action.button("⏹️ Cancel", key=f"cancel_{job_id}"):
+                    manager.cancel(job_id)
+                    st.info("⏹️ Cancel requested; the job stops at its next checkpoint.")
+            else:
+                if state != DONE and col_action.button("▶️ Resume", key=f"resume_{job_id}"):
+                    manager.resume(job_id, api_key)
+                    st.info(f"▶️ Re-queued {job_id}.")
+                if col_action.button("🗑️ Delete", key=f"delete_{job_id}"):
+                    manager.delete(job_id)
+                    st.info(f"🗑️ Deleted {job_id}.")
+            output = manager.output_path(job_id)
+            # Enrichment output is valid CSV after every committed block, so partial results can be downloaded too.
+            if output and (state == DONE or job.get("kind") == "enrichment"):
+                with open(output, "rb") as f:
+                    col_output.download_button(
+                        "⬇️ Results CSV" if state == DONE else "⬇️ Partial results CSV", f.read(),
+                        file_name=f"{job_id}_{job.get('kind', 'job')}.csv", mime="text/csv", key=f"out_{job_id}"
+                    )
+            npz = manager.output_path(job_id, "embeddings.npz")
+            if npz and state == DONE:
+                with open(npz, "rb") as f:
+                    col_extra.download_button(
+                        "⬇️ Binary embeddings (.npz)", f.read(), file_name=f"{job_id}_embeddings.npz",
+                        mime="application/octet-stream", key=f"npz_{job_id}"
+                    )
+
+# 6) Similarity search
+st.markdown("---")
+st.header("🔍 Search Chunks")
+search_source = "this session's embeddings"
+if not st.session_state.get("embeddings_result"):
+    search_source = "uploaded files"
+    st.caption("Generate embeddings above, or upload a chunk_embeddings.npz with its embeddings CSV.")
+    npz_file = st.file_uploader("Upload chunk_embeddings.npz", key="search_npz", type="npz")
+    search_csv = st.file_uploader("Upload the matching embeddings CSV", key="search_csv", type="csv")
+
+index_key = None
+if st.session_state.get("embeddings_result"):
+    df_search, row_ids, matrix, _, _ = st.session_state["embeddings_result"]
+    index_key = ("session", id(matrix))
+elif npz_file and search_csv:
+    index_key = ("upload", npz_file.name, npz_file.size, search_csv.name, search_csv.size)
+
+if index_key is not None:
+    # The index is built once per embeddings result and kept across reruns.
+    cached = st.session_state.get("search_index")
+    if not cached or cached[0] != index_key:
+        with st.spinner("Building search index..."):
+            if index_key[0] == "session":
+                index = VectorIndex(row_ids, matrix)
+            else:
+                index = load_npz_index(npz_file)
+                df_search = pd.read_csv(search_csv)
+        st.session_state["search_index"] = (index_key, index, df_search)
+    _, index, df_search = st.session_state["search_index"]
+    st.caption(f"{len(index)} vectors from {search_source} · "
+               f"{'approximate (IVF)' if index.is_approximate else 'exact'} search")
+
+    query = st.text_input("Find chunks about...", key="search_query")
+    top_k = st.slider("Results", min_value=1, max_value=50, value=config.SEARCH_TOP_K)
+    if query:
+        provider = get_embedding_provider(embed_model, embed_url, api_key)
+        try:
+            hits = index.search_text(provider, query, k=top_k)
+        except Exception as e:
+            st.error(f"❌ Search failed: {e}")
+        else:
+            st.dataframe(hits_to_frame(df_search, hits))
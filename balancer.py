@@ -0,0 +1,218 @@
+"""
+Weighted multi-provider / multi-key load balancing with failover.
+
+A ProviderPool looks like a single chat provider (`complete(prompt)`), so it can be
+handed to enrichment.Enricher in place of one adapter. Each call is routed to a pool
+member chosen at random in proportion to its weight among the members that are
+currently usable. A member is usable when its requests-per-minute budget (token
+bucket) has room and it is not cooling down after an error. 429s park a member for its
+Retry-After; timeouts and 5xx park it with exponential backoff; 401/403 park it for a
+long time (bad or exhausted key). A failed call is retried on the next member, so an
+outage at one provider only costs the failed attempt.
+
+Members come from config.PROVIDER_POOL, a JSON list such as
+    [{"backend": "openai", "api_key_env": "OPENAI_KEY_2", "weight": 2, "rpm": 500},
+     {"backend": "deepseek", "api_key_env": "DEEPSEEK_KEY", "rpm": 60}]
+where "backend" is a key of config.CHAT_BACKENDS, and "model"/"api_url"/"api_key"
+may override the defaults.
+"""
+import json
+import os
+import random
+import threading
+import time
+from typing import List, Optional
+
+import config
+from providers import ChatResponse, ProviderError, get_chat_provider
+
+# Cool-down after an authentication/permission failure, in seconds.
+_AUTH_COOLDOWN = 600.0
+
+
+class PoolMember:
+    """One provider/key in the pool with its rate-limit bucket and health state."""
+
+    def __init__(self, provider, weight: float = 1.0, rpm: Optional[float] = None, label: str = ""):
+        self.provider = provider
+        self.weight = max(float(weight), 0.0)
+        self.rpm = rpm
+        self.label = label or f"{provider.name}:{provider.model_name}"
+        self.capacity = max(1.0, rpm / 60.0) if rpm else None
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.last_error = ""
+
+    def _refill(self, now: float) -> None:
+        if self.capacity is None:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rpm / 60.0)
+        self.refilled_at = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until this member may take another request (0 = now)."""
+        self._refill(now)
+        wait = max(self.cooldown_until - now, 0.0)
+        if self.capacity is not None and self.tokens < 1.0:
+            wait = max(wait, (1.0 - self.tokens) * 60.0 / self.rpm)
+        return wait
+
+
+class ProviderPool:
+    """Chat-provider facade that spreads calls over weighted, rate-limited members."""
+
+    name = "pool"
+    # Passed through to each member, which applies it only where its API supports it.
+    supports_json_mode = True
+
+    def __init__(self, members: List[PoolMember], max_wait: Optional[float] = None):
+        if not members:
+            raise ValueError("ProviderPool needs at least one member")
+        self.members = members
+        self.max_wait = config.POOL_MAX_WAIT if max_wait is None else max_wait
+        self.model_name = "+".join(sorted({m.provider.model_name for m in members}))
+        # Used (with model_name) as the response-cache namespace for pooled runs.
+        self.api_url = "pool:" + ",".join(sorted({m.provider.api_url for m in members}))
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+
+    def _acquire(self, exclude) -> Optional[PoolMember]:
+        """Blocks until a member outside `exclude` is usable, takes one of its tokens."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                candidates = [m for m in self.members if m not in exclude and m.weight > 0]
+                if not candidates:
+                    return None
+                waits = {m: m.ready_in(now) for m in candidates}
+                ready = [m for m in candidates if waits[m] == 0.0]
+                if ready:
+                    member = self._rng.choices(ready, weights=[m.weight for m in ready])[0]
+                    if member.capacity is not None:
+                        member.tokens -= 1.0
+                    return member
+                wait = min(waits.values())
+            if now + wait > deadline:
+                return None
+            time.sleep(min(wait, 1.0))
+
+    def _penalize(self, member: PoolMember, error: ProviderError) -> None:
+        with self._lock:
+            now = time.monotonic()
+            member.last_error = str(error)
+            if error.status == 429:
+                cooldown = error.retry_after if error.retry_after is not None else config.POOL_RATE_LIMIT_COOLDOWN
+            elif error.status in (401, 403):
+                cooldown = _AUTH_COOLDOWN
+            else:
+                member.failures += 1
+                cooldown = min(2.0 ** member.failures, 60.0)
+            member.cooldown_until = max(member.cooldown_until, now + cooldown)
+
+    def _reward(self, member: PoolMember) -> None:
+        with self._lock:
+            member.failures = 0
+
+    def complete(self, prompt: str, json_mode: bool = False) -> ChatResponse:
+        return self._dispatch(lambda provider: provider.complete(prompt, json_mode=json_mode))
+
+    def stream(self, prompt: str, json_mode: bool = False, on_text=None, new_listener=None) -> ChatResponse:
+        # Each member attempt calls new_listener() again, so a failover starts with fresh listener state.
+        return self._dispatch(lambda provider: provider.stream(
+            prompt, json_mode=json_mode, on_text=on_text, new_listener=new_listener,
+        ))
+
+    def _dispatch(self, call) -> ChatResponse:
+        attempted = set()
+        last_error = None
+        while len(attempted) < len(self.members):
+            member = self._acquire(attempted)
+            if member is None:
+                break
+            attempted.add(member)
+            try:
+                response = call(member.provider)
+            except ProviderError as e:
+                self._penalize(member, e)
+                last_error = e
+                # Even a 400/404 is usually specific to the member (its model, URL or
+                # parameters), so every member gets a try before the call fails.
+                continue
+            self._reward(member)
+            return response._replace(provider=member.label)
+        raise last_error or ProviderError("No provider in the pool is available", status=503)
+
+    def status(self) -> list:
+        """Snapshot of each member's health, for display."""
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "member": m.label, "weight": m.weight, "rpm": m.rpm,
+                    "cooling_down_s": round(max(m.cooldown_until - now, 0.0), 1),
+                    "consecutive_failures": m.failures, "last_error": m.last_error,
+                }
+                for m in self.members
+            ]
+
+
+def load_pool_spec(spec: Optional[str] = None) -> list:
+    """
+    Parses config.PROVIDER_POOL (inline JSON or a path to a JSON file). Raises
+    ValueError naming the problem when the file is missing, the JSON is malformed, or
+    an entry is not an object with a known "backend".
+    """
+    spec = (spec if spec is not None else config.PROVIDER_POOL).strip()
+    if not spec:
+        return []
+    source = "PROVIDER_POOL"
+    if spec[0] not in "[{":
+        source = spec
+        try:
+            with open(spec, "r", encoding="utf-8") as f:
+                spec = f.read()
+        except OSError as e:
+            raise ValueError(f"Cannot read the provider pool file {source}: {e}") from e
+    try:
+        entries = json.loads(spec)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Malformed provider pool JSON in {source}: {e}") from e
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError(f"The provider pool in {source} must be a JSON list of objects")
+    for entry in entries:
+        _backend_defaults(entry)
+    return entries
+
+
+def _backend_defaults(entry: dict) -> tuple:
+    """(default model, default API URL) for a pool entry's backend."""
+    backend = entry.get("backend", "openai")
+    if backend not in config.CHAT_BACKENDS:
+        raise ValueError(
+            f"Unknown provider pool backend {backend!r}; expected one of {', '.join(config.CHAT_BACKENDS)}"
+        )
+    return config.CHAT_BACKENDS[backend]
+
+
+def build_pool(entries: list, extra_members: Optional[List[PoolMember]] = None) -> Optional[ProviderPool]:
+    """
+    Builds a ProviderPool from pool-spec entries plus any `extra_members` (e.g. the
+    key pasted into the app). Entries whose key is not available are skipped.
+    Returns None when nothing usable is left; raises ValueError for an unknown backend.
+    """
+    members = list(extra_members or [])
+    for entry in entries:
+        backend = entry.get("backend", "openai")
+        default_model, default_url = _backend_defaults(entry)
+        api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", ""), "")
+        if not api_key:
+            continue
+        provider = get_chat_provider(entry.get("model", default_model), entry.get("api_url", default_url), api_key)
+        members.append(PoolMember(
+            provider, weight=entry.get("weight", 1.0), rpm=entry.get("rpm"),
+            label=entry.get("label") or f"{backend}:{entry.get('api_key_env') or 'key'}",
+        ))
+    return ProviderPool(members) if members else None
@@ -0,0 +1,293 @@
+"""
+Local stand-in for the chat and embedding APIs, for offline benchmarks.
+
+Speaks the request/response formats the provider adapters use:
+    POST .../chat/completions        OpenAI / DeepSeek chat
+    POST .../messages                Anthropic Messages
+    POST .../models/<m>:generateContent   Gemini (:streamGenerateContent?alt=sse streams)
+    POST .../embeddings              OpenAI embeddings
+Chat requests with "stream": true (and Gemini's streaming endpoint) are answered as
+server-sent events, the answer split over several deltas.
+Answers are synthetic but well-formed for the enrichment prompts (chapter, chunk and
+packed-chunk JSON), continuing an Anthropic assistant prefill when one is sent. Latency, 429/5xx injection and malformed-JSON answers are drawn
+from a seeded RNG so runs are repeatable. `--stall` makes a fraction of streams go
+silent halfway through, for exercising stall detection.
+
+    python -m benchmarks.mock_llm_server --port 8765 --latency lognormal:0.05,0.5 --error-429 0.02
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_PACK_ID_RE = re.compile(r"---START CHUNK id=([^-\s]+)---")
+
+
+def parse_latency(spec: str):
+    """
+    Returns a sampler for a latency spec in seconds: "fixed:0.2", "uniform:0.1,0.5"
+    or "lognormal:<median>,<sigma>".
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+def _chunk_answer(seed: str) -> dict:
+    return {
+        "Wisdom": f"Insight {seed[:8]}: patience turns effort into understanding.",
+        "Reflections": f"Reflection {seed[8:16]}: the passage invites a slower reading.",
+        "ChunkOutline": ["Opening idea", "Supporting example", "Conclusion"],
+        "ChunkQuestions": ["What would change if the author were wrong?"],
+    }
+
+
+def synthetic_answer(prompt: str) -> str:
+    """A valid JSON answer for whichever enrichment prompt this is."""
+    seed = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    ids = _PACK_ID_RE.findall(prompt)
+    if ids:
+        return json.dumps({"results": [dict(_chunk_answer(seed + str(i)), id=_maybe_int(i)) for i in ids]})
+    if "title of a chapter" in prompt:
+        return json.dumps({
+            "ChapterSummary": f"Summary {seed[:8]} of a chapter about growth and doubt.",
+            "ChapterOutline": ["Setting", "Conflict", "Resolution"],
+            "ChapterQuestions": ["What is at stake?", "Who changes most?"],
+        })
+    return json.dumps(_chunk_answer(seed))
+
+
+def _maybe_int(value: str):
+    return int(value) if value.isdigit() else value
+
+
+def synthetic_embedding(text: str, dim: int):
+    """Deterministic pseudo-random unit vector for `text`."""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vec = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+class MockState:
+    """Behaviour knobs plus request counters shared by all handler threads."""
+
+    def __init__(self, latency="fixed:0", error_429=0.0, error_5xx=0.0, malformed=0.0,
+                 embedding_dim=256, seed=0, stall=0.0, stall_seconds=60.0):
+        self.sample_latency = parse_latency(latency)
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.malformed = malformed
+        self.stall = stall
+        self.stall_seconds = stall_seconds
+        self.embedding_dim = embedding_dim
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def draw(self):
+        """Returns (latency, outcome) with outcome in ok / 429 / 5xx / malformed / stall."""
+        with self._lock:
+            latency = max(self.sample_latency(self._rng), 0.0)
+            roll = self._rng.random()
+        if roll < self.error_429:
+            return latency, "429"
+        if roll < self.error_429 + self.error_5xx:
+            return latency, "5xx"
+        if roll < self.error_429 + self.error_5xx + self.malformed:
+            return latency, "malformed"
+        if roll < self.error_429 + self.error_5xx + self.malformed + self.stall:
+            return latency, "stall"
+        return latency, "ok"
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so client connection pooling is exercised
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, events, latency: float, stall: bool):
+        """
+        Streams `events` as SSE with chunked transfer encoding, one chunk per event, like
+        the real APIs. The first arrives after a fifth of `latency`, the rest spread over it.
+        """
+        time.sleep(latency * 0.2)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, event in enumerate(events):
+            if stall and i == len(events) // 2:
+                # Go quiet mid-body, then drop the connection without the final chunk.
+                time.sleep(self.state.stall_seconds)
+                self.close_connection = True
+                return
+            payload = event if isinstance(event, str) else json.dumps(event)
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+            time.sleep(latency * 0.8 / len(events))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send(400, {"error": {"message": "invalid JSON body"}})
+
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/embeddings"):
+            kind = "embeddings"
+        elif path.endswith("/chat/completions"):
+            kind = "openai"
+        elif path.endswith("/messages"):
+            kind = "anthropic"
+        elif ":generateContent" in path or ":streamGenerateContent" in path:
+            kind = "gemini"
+        else:
+            return self._send(404, {"error": {"message": f"unknown endpoint {path}"}})
+        stream = kind != "embeddings" and (bool(request.get("stream")) or ":streamGenerateContent" in path)
+
+        latency, outcome = self.state.draw()
+        if outcome == "stall" and not stream:
+            outcome = "ok"
+        if not stream or outcome in ("429", "5xx"):
+            time.sleep(latency)
+        self.state.count(f"{kind}:{outcome}")
+        if outcome == "429":
+            return self._send(429, {"error": {"message": "rate limited"}}, {"Retry-After": "1"})
+        if outcome == "5xx":
+            return self._send(503, {"error": {"message": "overloaded"}})
+
+        if kind == "embeddings":
+            inputs = request.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            data = [
+                {"object": "embedding", "index": i, "embedding": synthetic_embedding(text, self.state.embedding_dim)}
+                for i, text in enumerate(inputs)
+            ]
+            tokens = sum(len(text) // 4 + 1 for text in inputs)
+            return self._send(200, {"data": data, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+        if kind == "gemini":
+            prompt = "".join(p.get("text", "") for c in request.get("contents", []) for p in c.get("parts", []))
+        else:
+            prompt = "".join(str(m.get("content", "")) for m in request.get("messages", []) if m.get("role") != "assistant")
+        answer = synthetic_answer(prompt)
+        messages = request.get("messages") or [{}]
+        prefill = messages[-1].get("content", "") if messages[-1].get("role") == "assistant" else ""
+        if kind == "anthropic" and answer.startswith(prefill):
+            answer = answer[len(prefill):]  # The client already has the prefilled start of the answer
+        if outcome == "malformed":
+            answer = answer[: max(1, len(answer) // 2)]  # Truncated mid-object, like a cut-off completion
+        prompt_tokens, completion_tokens = len(prompt) // 4 + 1, len(answer) // 4 + 1
+
+        if stream:
+            step = max(1, len(answer) // 8)
+            pieces = [answer[i:i + step] for i in range(0, len(answer), step)]
+            if kind == "openai":
+                events = [{"choices": [{"index": 0, "delta": {"content": piece}}]} for piece in pieces]
+                events.append({"choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}})
+                events.append("[DONE]")
+            elif kind == "anthropic":
+                events = [{"type": "message_start", "message": {"usage": {"input_tokens": prompt_tokens, "output_tokens": 1}}}]
+                events += [{"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}
+                           for piece in pieces]
+                events += [{"type": "message_delta", "usage": {"output_tokens": completion_tokens}}, {"type": "message_stop"}]
+            else:
+                events = [{"candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}]} for piece in pieces]
+                events[-1]["usageMetadata"] = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens}
+            return self._send_events(events, latency, outcome == "stall")
+
+        if kind == "openai":
+            body = {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+            }
+        elif kind == "anthropic":
+            body = {
+                "content": [{"type": "text", "text": answer}],
+                "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+            }
+        else:
+            body = {
+                "candidates": [{"content": {"parts": [{"text": answer}], "role": "model"}}],
+                "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens},
+            }
+        return self._send(200, body)
+
+
+def start_mock_server(host="127.0.0.1", port=0, **state_options):
+    """Starts the server on a daemon thread. Returns (server, base_url, state)."""
+    state = MockState(**state_options)
+    handler = type("MockHandler", (_Handler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}", state
+
+
+def add_state_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", default="lognormal:0.05,0.5",
+                        help='Per-request latency: "fixed:S", "uniform:A,B" or "lognormal:MEDIAN,SIGMA"')
+    parser.add_argument("--error-429", type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Fraction of requests answered 503")
+    parser.add_argument("--malformed", type=float, default=0.0, help="Fraction of chat answers truncated mid-JSON")
+    parser.add_argument("--stall", type=float, default=0.0, help="Fraction of streamed answers that go silent halfway")
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def state_options(args) -> dict:
+    return {
+        "latency": args.latency, "error_429": args.error_429, "error_5xx": args.error_5xx,
+        "malformed": args.malformed, "embedding_dim": args.embedding_dim, "seed": args.seed,
+        "stall": args.stall,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Mock chat/embedding API server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_state_arguments(parser)
+    args = parser.parse_args(argv)
+    server, base_url, _ = start_mock_server(args.host, args.port, **state_options(args))
+    print(f"Mock API listening on {base_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
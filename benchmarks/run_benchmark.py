@@ -0,0 +1,162 @@
+"""
+Offline performance benchmark for the enrichment and embedding pipelines.
+
+Starts the mock API server (benchmarks/mock_llm_server.py), generates synthetic books,
+and runs the same code the app and CLI use (enrichment.Enricher.enrich_frame and
+improvement4.embed_texts) against it. No API key or network access is needed.
+
+    python -m benchmarks.run_benchmark --sizes 1000,10000 --concurrency 16 --pack
+    python -m benchmarks.run_benchmark --sizes 1000 --error-429 0.05 --malformed 0.02 --json bench.json
+
+For each book size it reports wall time, rows/s, peak traced Python memory, HTTP calls,
+wasted calls (retries, failed calls and answers that could not be parsed) and p50/p95
+call latency, so results can be compared release to release.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.mock_llm_server import add_state_arguments, start_mock_server, state_options
+from enrichment import Enricher
+from improvement4 import embed_texts
+from providers import get_embedding_provider
+from telemetry import RunTelemetry
+
+_VOCAB = (
+    "patience wisdom river silence journey doubt promise memory light shadow mercy truth "
+    "courage garden letter morning hunger teacher stranger harvest mountain prayer bridge "
+    "honest broken quietly slowly returned carried remembered forgave listened wandered"
+).split()
+
+CHAT_PATHS = {
+    "openai": "/v1/chat/completions",
+    "anthropic": "/v1/messages",
+    "gemini": "/v1beta/models/mock-model:generateContent",
+}
+
+
+def synthetic_book(n_chunks: int, chunk_words: int = 150, chunk_per_chapter: int = 50, seed: int = 0) -> pd.DataFrame:
+    """A book of `n_chunks` random-word chunks grouped into chapters."""
+    rng = random.Random(seed)
+    return pd.DataFrame({
+        "Detected Title": [f"Chapter {i // chunk_per_chapter + 1}" for i in range(n_chunks)],
+        "Text Chunk": [" ".join(rng.choice(_VOCAB) for _ in range(chunk_words)) for _ in range(n_chunks)],
+    })
+
+
+def wasted_calls(telemetry: RunTelemetry) -> int:
+    """HTTP requests whose answer was not used: retries, failed calls, unparseable answers."""
+    wasted = 0
+    for r in telemetry.records:
+        if r.cached:
+            continue
+        wasted += r.retries
+        if r.error or r.parse_ok is False:
+            wasted += 1
+    return wasted
+
+
+def _measure(label: str, run) -> dict:
+    telemetry = RunTelemetry(label=label)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    run(telemetry)
+    wall = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    summary = telemetry.summary()
+    return {
+        "phase": label,
+        "rows": summary["rows_done"],
+        "wall_s": round(wall, 3),
+        "rows_per_s": round(summary["rows_done"] / wall, 2) if wall else 0.0,
+        "peak_mem_mb": round(peak / 1e6, 2),
+        "http_calls": summary["http_calls"],
+        "wasted_calls": wasted_calls(telemetry),
+        "latency_p50_ms": round(summary["latency_p50_s"] * 1000, 1) if summary["latency_p50_s"] is not None else None,
+        "latency_p95_ms": round(summary["latency_p95_s"] * 1000, 1) if summary["latency_p95_s"] is not None else None,
+        "first_token_p50_ms": (round(summary["first_token_p50_s"] * 1000, 1)
+                               if summary["first_token_p50_s"] is not None else None),
+    }
+
+
+def run_suite(base_url: str, sizes, api: str, concurrency: int, pack: bool, skip_embeddings: bool, notify,
+              stream: bool = False) -> list:
+    results = []
+    for size in sizes:
+        book = synthetic_book(size)
+
+        def _enrich(telemetry, book=book):
+            enricher = Enricher(
+                "mock-model", base_url + CHAT_PATHS[api], "mock-key",
+                max_concurrency=concurrency, pack_chunks=pack,
+                cache=None, notify=notify, telemetry=telemetry, stream=stream,
+            )
+            enricher.enrich_frame(book)
+
+        results.append(dict(_measure(f"enrich[{api}]", _enrich), size=size))
+
+        if not skip_embeddings:
+            texts = book["Text Chunk"].tolist()
+
+            def _embed(telemetry, texts=texts):
+                provider = get_embedding_provider("mock-embedding", base_url + "/v1/embeddings", "mock-key")
+                embed_texts(provider, texts, telemetry=telemetry, notify=notify)
+
+            results.append(dict(_measure("embed", _embed), size=size))
+    return results
+
+
+def _print_table(results) -> None:
+    columns = ["size", "phase", "wall_s", "rows_per_s", "peak_mem_mb", "http_calls", "wasted_calls",
+               "latency_p50_ms", "latency_p95_ms", "first_token_p50_ms"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in results)) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for r in results:
+        print("  ".join(str(r[c]).rjust(widths[c]) for c in columns))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark enrichment/embeddings against a local mock API.")
+    parser.add_argument("--sizes", default="1000", help="Comma-separated book sizes in chunks (e.g. 1000,10000,100000)")
+    parser.add_argument("--api", choices=sorted(CHAT_PATHS), default="openai", help="Chat wire format to exercise")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--pack", action="store_true", help="Pack several chunks per chat request")
+    parser.add_argument("--stream", action="store_true", help="Stream chat answers (server-sent events)")
+    parser.add_argument("--skip-embeddings", action="store_true")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Print enrichment warnings and errors")
+    add_state_arguments(parser)
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    server, base_url, state = start_mock_server(**state_options(args))
+    messages = {"warning": 0, "error": 0}
+
+    def _notify(level, message):
+        if level in messages:
+            messages[level] += 1
+            if args.verbose:
+                print(f"[{level}] {message}", file=sys.stderr)
+
+    try:
+        results = run_suite(base_url, sizes, args.api, args.concurrency, args.pack, args.skip_embeddings, _notify,
+                            stream=args.stream)
+    finally:
+        server.shutdown()
+
+    _print_table(results)
+    print(f"\nmock server outcomes: {state.counts}  ·  pipeline messages: {messages}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results, "server_counts": state.counts}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Headless enrichment for large books.
+
+    python cli.py book.csv enriched.csv --provider deepseek --api-key sk-...
+
+The input CSV is read in blocks of --block-size rows; each enriched block is appended to
+the output CSV and then committed to a checkpoint journal (<output>.journal). If the run
+dies, running the same command again truncates the output back to the last committed
+block and resumes from there, reusing the chapter answers already obtained.
+Memory use is bounded by the block size, not by the size of the book.
+The checkpointed runner itself is enrichment.enrich_csv_file, shared with background jobs.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import config
+from balancer import PoolMember, build_pool, load_pool_spec
+from enrichment import Enricher, enrich_csv_file
+from llm_cache import get_response_cache
+from providers import get_chat_provider
+from telemetry import RunTelemetry, format_summary
+
+logger = logging.getLogger("enricher")
+
+
+def log_notify(level: str, message: str) -> None:
+    """Routes enrichment messages to the `enricher` logger."""
+    log_level = {"error": logging.ERROR, "warning": logging.WARNING}.get(level, logging.INFO)
+    logger.log(log_level, message)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Enrich a chunked book CSV without the Streamlit UI.")
+    parser.add_argument("input", help="CSV with 'Detected Title' and 'Text Chunk' columns")
+    parser.add_argument("output", help="Enriched CSV to write (appended to while running)")
+    parser.add_argument("--provider", choices=sorted(config.CHAT_BACKENDS), default="openai",
+                        help="Chat backend from config.py (default: openai)")
+    parser.add_argument("--model", help="Override the provider's model name")
+    parser.add_argument("--api-url", help="Override the provider's API URL")
+    parser.add_argument("--api-key", default=os.getenv("CHAT_API_KEY") or os.getenv("OPENAI_API_KEY"),
+                        help="API key (default: $CHAT_API_KEY or $OPENAI_API_KEY)")
+    parser.add_argument("--block-size", type=int, default=200,
+                        help="Rows per checkpointed block (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=config.MAX_CONCURRENT_REQUESTS,
+                        help="Chunk requests in flight at once")
+    parser.add_argument("--pack", action="store_true", help="Pack several chunks into each request")
+    parser.add_argument("--stream", action="store_true", default=config.STREAMING,
+                        help="Stream answers (stalls are detected after STREAM_STALL_TIMEOUT seconds)")
+    parser.add_argument("--encoding", help="Input encoding (default: auto-detect)")
+    parser.add_argument("--restart", action="store_true", help="Ignore any checkpoint and start over")
+    parser.add_argument("--pool", action="store_true",
+                        help="Spread calls over config.PROVIDER_POOL (plus --provider/--api-key if given)")
+    parser.add_argument("--report", help="Write a JSON run report (per-call latency, tokens, retries) here")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    model_name, api_url = config.CHAT_BACKENDS[args.provider]
+    model_name, api_url = args.model or model_name, args.api_url or api_url
+    pool = None
+    if args.pool:
+        own = [PoolMember(get_chat_provider(model_name, api_url, args.api_key), label=args.provider)] if args.api_key else []
+        try:
+            pool = build_pool(load_pool_spec(), own)
+        except ValueError as e:
+            parser.error(str(e))
+        if pool is None:
+            parser.error("--pool needs PROVIDER_POOL entries with available keys, or --api-key")
+        logger.info("⚖️ Provider pool: %s", ", ".join(m.label for m in pool.members))
+    elif not args.api_key:
+        parser.error("an API key is required (--api-key or $CHAT_API_KEY)")
+
+    telemetry = RunTelemetry(label="pool" if pool else f"{args.provider} ({model_name})")
+    enricher = Enricher(
+        pool.model_name if pool else model_name, pool.api_url if pool else api_url, args.api_key,
+        max_concurrency=args.concurrency,
+        pack_chunks=args.pack,
+        cache=get_response_cache(),
+        notify=log_notify,
+        telemetry=telemetry,
+        provider=pool,
+        stream=args.stream,
+    )
+
+    started = time.monotonic()
+
+    def _progress(rows_done):
+        logger.info("✅ %d rows committed (%.0fs elapsed) · %s", rows_done, time.monotonic() - started,
+                    format_summary(telemetry.summary()))
+
+    try:
+        rows_done = enrich_csv_file(
+            args.input, args.output, enricher,
+            block_size=args.block_size, encoding=args.encoding,
+            restart=args.restart, progress=_progress,
+        )
+    except ValueError as e:
+        logger.error("❌ %s", e)
+        return 1
+    finally:
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                f.write(telemetry.to_json())
+    logger.info("✅ Enrichment completed: %d rows in %s", rows_done, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
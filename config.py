@@ -18,6 +18,9 @@ DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/ch
 # --- Anthropic Claude Configuration ---
 ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL", "claude-3-7-sonnet-20250219") 
 ANTHROPIC_API_URL = os.getenv("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")
+ANTHROPIC_VERSION = os.getenv("ANTHROPIC_VERSION", "2023-06-01")
+# The Messages API requires an explicit output cap.
+ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "4096"))
 
 # --- Google Gemini Configuration ---
 # Used when you select "Google Gemini Pro" in the app
@@ -35,10 +38,110 @@ GEMINI_API_URL = os.getenv(
     "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro-preview-03-25:generateContent"
 )
 
+# --- Chat Backends ---
+# Short names for the chat backends above, used by the CLI and the provider pool.
+CHAT_BACKENDS = {
+    "deepseek":  (DEEPSEEK_MODEL,  DEEPSEEK_API_URL),
+    "openai":    (MODEL_NAME,      API_URL),
+    "anthropic": (ANTHROPIC_MODEL, ANTHROPIC_API_URL),
+    "gemini":    (GEMINI_MODEL,    GEMINI_API_URL),
+}
+
 # --- Embeddings Configuration (Using OpenAI) ---
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
 EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "https://api.openai.com/v1/embeddings")
 
+# Embedding requests are split into batches bounded by both item count and estimated
+# tokens, sent EMBEDDING_MAX_CONCURRENCY at a time, and retried on transient errors.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+
+# --- CSV Ingestion Configuration ---
+# "auto" uses the pyarrow CSV reader when pyarrow is installed, "c" forces pandas' C parser.
+CSV_ENGINE = os.getenv("CSV_ENGINE", "auto")
+
+# --- Concurrency Configuration ---
+# Maximum number of chunk prompts kept in flight at once during enrichment.
+# Raise it up to what your provider's rate limit allows; 1 restores sequential calls.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+
+# --- HTTP Client Configuration ---
+# Provider adapters (providers.py) keep one pooled keep-alive client per endpoint.
+# HTTP_POOL_MAXSIZE should be at least the highest concurrency you use.
+# HTTP2_ENABLED switches to an HTTP/2 client when `pip install "httpx[http2]"` is present.
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0").lower() in ("1", "true", "yes")
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "90"))
+
+# --- Provider Pool (Load Balancing) Configuration ---
+# Optional JSON list (inline, or a path to a JSON file) of extra backends/keys to spread
+# enrichment calls over, e.g.
+#   [{"backend": "openai", "api_key_env": "OPENAI_KEY_2", "weight": 2, "rpm": 500},
+#    {"backend": "deepseek", "api_key_env": "DEEPSEEK_KEY", "rpm": 60}]
+# Keys are read from the named environment variables; see balancer.py.
+PROVIDER_POOL = os.getenv("PROVIDER_POOL", "")
+# Longest a call waits for a pool member to free up before failing.
+POOL_MAX_WAIT = float(os.getenv("POOL_MAX_WAIT", "120"))
+# Cool-down for a member answering 429 without a Retry-After header.
+POOL_RATE_LIMIT_COOLDOWN = float(os.getenv("POOL_RATE_LIMIT_COOLDOWN", "10"))
+
+# --- Chunk Packing Configuration ---
+# When packing is enabled, consecutive chunks share one prompt. A pack holds at most
+# CHUNK_PACK_MAX_CHUNKS chunks and about CHUNK_PACK_TOKEN_BUDGET estimated tokens
+# (chunk text plus the expected answer), so keep the budget under the model's limits.
+CHUNK_PACK_TOKEN_BUDGET = int(os.getenv("CHUNK_PACK_TOKEN_BUDGET", "6000"))
+CHUNK_PACK_MAX_CHUNKS = int(os.getenv("CHUNK_PACK_MAX_CHUNKS", "10"))
+
+# --- LLM Response Cache Configuration ---
+# Raw API responses are stored on disk keyed by a hash of (API URL, model, prompt),
+# so re-running enrichment on an unchanged or mostly-unchanged book is free.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "512"))
+LLM_CACHE_MAX_AGE_DAYS = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "90"))
+
+# --- Embedding Store Configuration ---
+# Embedding vectors are stored on disk (float32) keyed by (embedding model, hash of the
+# normalized chunk text), so re-embedding a book only sends new or changed chunks.
+EMBEDDING_STORE_ENABLED = os.getenv("EMBEDDING_STORE_ENABLED", "1").lower() not in ("0", "false", "no")
+EMBEDDING_STORE_PATH = os.getenv("EMBEDDING_STORE_PATH", os.path.join(".cache", "embeddings.sqlite3"))
+EMBEDDING_STORE_MAX_MB = float(os.getenv("EMBEDDING_STORE_MAX_MB", "1024"))
+EMBEDDING_STORE_MAX_AGE_DAYS = float(os.getenv("EMBEDDING_STORE_MAX_AGE_DAYS", "180"))
+
+# --- Vector Search Configuration ---
+# Below VECTOR_INDEX_IVF_MIN_ROWS chunks the search panel scans every vector (exact);
+# above it an IVF index is built and each query scans the VECTOR_INDEX_NPROBE closest
+# lists. Raise NPROBE for better recall at some cost in latency.
+VECTOR_INDEX_IVF_MIN_ROWS = int(os.getenv("VECTOR_INDEX_IVF_MIN_ROWS", "20000"))
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "10"))
+
+# --- Background Jobs Configuration ---
+# Jobs submitted from the app run in JOB_WORKERS worker processes; their input, status
+# and results are kept under JOBS_DIR/<job id>/. JOB_BLOCK_SIZE is the checkpoint size
+# (rows) of enrichment jobs.
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+JOB_BLOCK_SIZE = int(os.getenv("JOB_BLOCK_SIZE", "200"))
+
+# --- Structured Output Configuration ---
+# STRUCTURED_OUTPUT asks each provider for its native JSON output (OpenAI/DeepSeek
+# response_format, Gemini responseMimeType, an Anthropic "{" prefill). Answers that stay
+# invalid after local repair are asked again up to SCHEMA_REASKS times.
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1").lower() not in ("0", "false", "no")
+SCHEMA_REASKS = int(os.getenv("SCHEMA_REASKS", "1"))
+
+# --- Streaming Configuration ---
+# STREAMING streams chat answers (server-sent events), so results show up while a
+# request is still generating. The first data may take REQUEST_TIMEOUT (reasoning models
+# send nothing until they answer); after it, a stream with no data for STREAM_STALL_TIMEOUT
+# seconds counts as stalled (the text received so far is kept); STREAM_MAX_SECONDS caps a stream.
+STREAMING = os.getenv("STREAMING", "0").lower() in ("1", "true", "yes")
+STREAM_STALL_TIMEOUT = float(os.getenv("STREAM_STALL_TIMEOUT", "20"))
+STREAM_MAX_SECONDS = float(os.getenv("STREAM_MAX_SECONDS", "600"))
+
 # ==============================================================================
 # End of Configuration
 # ==============================================================================
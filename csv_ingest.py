@@ -0,0 +1,237 @@
+"""
+Single-pass CSV ingestion.
+
+The encoding is detected once from a few samples spread over the file (start, middle
+and end, so a bad byte late in the file is seen too) and the file is then decoded and
+parsed exactly once. UTF-8 is tried first: a sample that is valid UTF-8 apart from a
+few stray bytes is read as UTF-8 with those bytes replaced (and counted), instead of
+letting one late bad byte push the whole book into a legacy codepage. chardet is only
+consulted when the sample is not UTF-8. Undecodable bytes are replaced rather than triggering a re-read,
+and malformed rows are collected while parsing so they can be reported afterwards.
+With `engine="pyarrow"` (or "auto" when pyarrow is installed) the multithreaded Arrow
+CSV reader is used.
+"""
+import codecs
+import csv
+import io
+import os
+import re
+import warnings
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import chardet
+import pandas as pd
+
+import config
+
+SAMPLE_BYTES = 64 * 1024
+# At most this many invalid sequences in the sample still count as (damaged) UTF-8.
+UTF8_MAX_INVALID = 8
+# chardet guesses below this confidence are reported as uncertain.
+LOW_CONFIDENCE = 0.5
+
+# pandas reports skipped rows as "Skipping line 12: expected 3 fields, saw 5".
+_SKIPPED_LINE_RE = re.compile(r"Skipping line (\d+): ([^\n]*)")
+
+
+@dataclass
+class CsvLoadReport:
+    encoding: str
+    confidence: float
+    engine: str
+    bad_rows: List[str] = field(default_factory=list)
+    replaced_chars: int = 0
+
+
+def _read_sample_parts(fileobj) -> list:
+    """Reads up to three SAMPLE_BYTES windows (start, middle, end) and rewinds."""
+    start = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell() - start
+    fileobj.seek(start)
+    if size <= 3 * SAMPLE_BYTES:
+        parts = [fileobj.read()]
+    else:
+        parts = []
+        for offset in (0, size // 2, size - SAMPLE_BYTES):
+            fileobj.seek(start + offset)
+            parts.append(fileobj.read(SAMPLE_BYTES))
+    fileobj.seek(start)
+    return parts
+
+
+def _utf8_damage(parts):
+    """
+    Returns (invalid, multibyte): invalid UTF-8 sequences and valid non-ASCII characters
+    in the sample windows. Characters cut in half at a window's edges are not counted.
+    """
+    invalid = multibyte = 0
+    for i, part in enumerate(parts):
+        if i > 0:
+            # A window may start inside a character: skip its continuation bytes.
+            skip = 0
+            while skip < min(3, len(part)) and 0x80 <= part[skip] <= 0xBF:
+                skip += 1
+            part = part[skip:]
+        # final=False: a character cut off at the window's end is not an error.
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pos = 0
+        while pos < len(part):
+            try:
+                text = decoder.decode(part[pos:], final=False)
+                multibyte += len(text) - len(text.encode("ascii", "ignore"))
+                break
+            except UnicodeDecodeError as e:
+                invalid += 1
+                if invalid > UTF8_MAX_INVALID:
+                    return invalid, multibyte
+                decoded = part[pos:pos + e.start].decode("utf-8")
+                multibyte += len(decoded) - len(decoded.encode("ascii", "ignore"))
+                pos += e.end
+                decoder.reset()
+    return invalid, multibyte
+
+
+def detect_encoding(source):
+    """
+    Detects the encoding of a path or seekable binary file object from a representative
+    sample. Returns (encoding, confidence). A UTF-8 byte-order mark selects 'utf-8-sig'.
+    A sample that decodes as UTF-8, or does so apart from a few invalid sequences among
+    genuine multibyte characters, is UTF-8 (the bad bytes get replaced when reading).
+    Otherwise chardet guesses; ASCII guesses are widened to UTF-8.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return detect_encoding(f)
+
+    parts = _read_sample_parts(source)
+    if parts[0].startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig", 1.0
+    invalid, multibyte = _utf8_damage(parts)
+    if invalid == 0:
+        return "utf-8", 1.0
+    if invalid <= UTF8_MAX_INVALID and invalid <= multibyte:
+        return "utf-8", min(0.99, round(multibyte / (multibyte + invalid), 2))
+    guess = chardet.detect(b"\n".join(parts))
+    encoding = (guess["encoding"] or "utf-8").lower()
+    if encoding in ("ascii", "utf-8"):
+        # An all-ASCII sample says nothing about bytes elsewhere; UTF-8 is the superset.
+        encoding = "utf-8"
+    return encoding, float(guess["confidence"] or 0.0)
+
+
+def _parse_skipped_lines(caught) -> List[str]:
+    bad_rows = []
+    for w in caught:
+        for line_no, reason in _SKIPPED_LINE_RE.findall(str(w.message)):
+            bad_rows.append(f"line {line_no}: {reason}")
+    return bad_rows
+
+
+def _count_replacements(df: pd.DataFrame) -> int:
+    total = 0
+    for col in df.columns:
+        if df[col].dtype == object:
+            total += int(df[col].astype(str).str.count("\ufffd").sum())
+    return total
+
+
+def _pyarrow_available() -> bool:
+    try:
+        import pyarrow.csv  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _read_with_pyarrow(data: bytes, encoding: str, report: CsvLoadReport) -> pd.DataFrame:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    # Every column is read as text, like dtype=object in the pandas path.
+    header_line = data[:SAMPLE_BYTES].decode(encoding, errors="replace").splitlines()[0]
+    names = next(csv.reader([header_line]))
+
+    def _on_invalid_row(row):
+        # The multithreaded reader doesn't know line numbers, so the row's text locates it.
+        if row.number is not None:
+            where = f"line {row.number}"
+        else:
+            text = row.text if len(row.text) <= 80 else row.text[:77] + "..."
+            where = f"malformed row {len(report.bad_rows) + 1} ({text!r})"
+        report.bad_rows.append(f"{where}: expected {row.expected_columns} fields, saw {row.actual_columns}")
+        return "skip"
+
+    table = pacsv.read_csv(
+        io.BytesIO(data),
+        read_options=pacsv.ReadOptions(encoding=encoding),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=_on_invalid_row),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in names}, strings_can_be_null=True
+        ),
+    )
+    return table.to_pandas()
+
+
+def load_csv(fileobj, engine: Optional[str] = None):
+    """
+    Loads a whole CSV (seekable binary file object) with every column as text.
+    Returns (DataFrame, CsvLoadReport). `engine` is "auto", "pyarrow" or "c"
+    (default: config.CSV_ENGINE). The pyarrow path falls back to pandas if the Arrow
+    reader rejects the file (e.g. undecodable bytes, which it cannot replace).
+    """
+    engine = (engine or config.CSV_ENGINE).lower()
+    encoding, confidence = detect_encoding(fileobj)
+    report = CsvLoadReport(encoding=encoding, confidence=confidence, engine="c")
+
+    if engine == "pyarrow" or (engine == "auto" and _pyarrow_available()):
+        import pyarrow as pa
+
+        start = fileobj.tell()
+        data = fileobj.read()
+        try:
+            df = _read_with_pyarrow(data, encoding, report)
+            report.engine = "pyarrow"
+            return df, report
+        except (pa.ArrowInvalid, UnicodeDecodeError, LookupError, IndexError):
+            report.bad_rows.clear()
+            fileobj.seek(start)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", pd.errors.ParserWarning)
+        df = pd.read_csv(
+            fileobj,
+            encoding=encoding,
+            encoding_errors="replace",
+            delimiter=',',
+            header=0,
+            dtype=object,
+            on_bad_lines='warn'
+        )
+    report.bad_rows.extend(_parse_skipped_lines(caught))
+    report.replaced_chars = _count_replacements(df)
+    return df, report
+
+
+def iter_csv_blocks(path, block_size: int, encoding: Optional[str] = None):
+    """
+    Streams a CSV file as DataFrame blocks of `block_size` rows (all columns text),
+    decoding it once. Yields (block, bad_rows) where bad_rows lists the malformed
+    lines pandas skipped while producing that block.
+    """
+    encoding = encoding or detect_encoding(path)[0]
+    reader = pd.read_csv(
+        path, encoding=encoding, encoding_errors="replace",
+        dtype=object, chunksize=block_size, on_bad_lines="warn"
+    )
+    with reader:
+        while True:
+            # Only capture while pandas parses, not while the caller holds the block.
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", pd.errors.ParserWarning)
+                try:
+                    block = next(reader)
+                except StopIteration:
+                    return
+            yield block, _parse_skipped_lines(caught)
@@ -0,0 +1,44 @@
+import numpy as np
+
+import config
+from sqlite_cache import SqliteLruCache, shared_cache
+
+
+class EmbeddingStore(SqliteLruCache):
+    """
+    On-disk (SQLite) store of float32 vectors keyed by (embedding model, text hash),
+    reused across runs so only new or changed chunk texts reach the embeddings API.
+    Entries older than `max_age_seconds` are treated as misses, and the least recently
+    used ones are evicted once the stored vectors exceed `max_bytes`.
+    """
+
+    table = "vectors"
+    key_columns = (("model", "TEXT"), ("text_hash", "TEXT"))
+    value_column = ("vector", "BLOB")
+
+    def get_many(self, model: str, hashes) -> dict:
+        """Returns {text_hash: float32 vector} for the hashes that are stored and fresh."""
+        found = self._get_many((model, text_hash) for text_hash in hashes)
+        return {text_hash: np.frombuffer(blob, dtype=np.float32) for (_, text_hash), blob in found.items()}
+
+    def put_many(self, model: str, items) -> None:
+        """Stores (text_hash, vector) pairs, then evicts expired and least recently used entries."""
+        rows = []
+        for text_hash, vector in items:
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append(((model, text_hash), blob, len(blob)))
+        self._put_many(rows)
+
+
+def get_embedding_store(path: str = None):
+    """
+    Returns the process-wide EmbeddingStore for `path` (config.EMBEDDING_STORE_PATH by
+    default), or None when the store is disabled.
+    """
+    if not config.EMBEDDING_STORE_ENABLED:
+        return None
+    return shared_cache(
+        EmbeddingStore, path or config.EMBEDDING_STORE_PATH,
+        max_bytes=int(config.EMBEDDING_STORE_MAX_MB * 1024 * 1024),
+        max_age_seconds=config.EMBEDDING_STORE_MAX_AGE_DAYS * 86400,
+    )
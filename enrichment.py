@@ -0,0 +1,696 @@
+"""
+UI-independent chapter & chunk enrichment.
+
+`Enricher` holds everything a run needs (model, endpoint, key, cache, concurrency) and
+enriches DataFrames in place. Messages go through a `notify(level, message)` callback
+(level is one of "write", "info", "success", "warning", "error") so the same code
+drives the Streamlit app (`improvement5.run_improvement5`) and the headless CLI (`cli.py`).
+
+`enrich_csv_file` streams a CSV through an Enricher block by block, committing each
+block to a checkpoint journal so an interrupted run (CLI or background job) resumes.
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import pandas as pd
+
+import config
+from csv_ingest import LOW_CONFIDENCE, detect_encoding, iter_csv_blocks
+from json_repair import TRUNCATED, StreamingItemParser, extract_json, parse_json
+from providers import ProviderError, get_chat_provider
+from telemetry import CallRecord, RunTelemetry
+from text_utils import estimate_tokens
+
+REQUIRED_COLUMNS = ["Detected Title", "Text Chunk"]
+CHAPTER_COLUMNS = ["ChapterSummary", "ChapterOutline", "ChapterQuestions"]
+CHUNK_COLUMNS = ["Wisdom", "Reflections", "ChunkOutline", "ChunkQuestions"]
+NEW_COLUMNS = CHAPTER_COLUMNS + CHUNK_COLUMNS
+CHUNK_RESULT_KEYS = tuple(CHUNK_COLUMNS)
+
+# Expected answer shapes: str = non-empty text, list = list of strings.
+CHAPTER_SCHEMA = {"ChapterSummary": str, "ChapterOutline": list, "ChapterQuestions": list}
+CHUNK_SCHEMA = {"Wisdom": str, "Reflections": str, "ChunkOutline": list, "ChunkQuestions": list}
+
+# Rough allowance for the JSON a model writes back per chunk, counted against the pack budget.
+_PACK_OUTPUT_TOKENS_PER_CHUNK = 250
+_HASH_BLOCK_BYTES = 1024 * 1024
+# Problem reported for an answer that only parsed after json_repair closed it.
+_CUT_OFF = "the answer was cut off before its JSON was complete"
+
+
+def print_notify(level: str, message: str) -> None:
+    """Fallback notifier: plain stdout."""
+    print(f"[{level}] {message}")
+
+
+def clean_json_string(raw_string: str) -> str:
+    """
+    Returns the JSON object/array in a response, dropping markdown fences and any prose
+    around it (brackets are matched, so nested objects are kept whole).
+    If there is no JSON, the response is returned stripped.
+    """
+    return extract_json(raw_string) or raw_string.strip()
+
+
+def validate_result(result, schema: dict):
+    """
+    Checks a parsed answer against `schema` (key -> str or list). Returns (cleaned,
+    problems): `cleaned` holds only the schema keys, with a lone string where a list is
+    expected wrapped into a list; `problems` lists what could not be fixed locally.
+    """
+    if not isinstance(result, dict):
+        return {}, [f"expected a JSON object, got {type(result).__name__}"]
+    cleaned, problems = {}, []
+    for key, kind in schema.items():
+        value = result.get(key)
+        if value is None:
+            problems.append(f"missing '{key}'")
+        elif kind is str:
+            if isinstance(value, list):
+                value = " ".join(str(v) for v in value)
+            if not isinstance(value, (str, int, float)) or not str(value).strip():
+                problems.append(f"'{key}' should be non-empty text")
+            else:
+                cleaned[key] = str(value).strip()
+        else:
+            if isinstance(value, str):
+                value = [value]
+            if not isinstance(value, list) or any(isinstance(v, (dict, list)) for v in value):
+                problems.append(f"'{key}' should be a list of strings")
+            else:
+                cleaned[key] = [str(v).strip() for v in value if str(v).strip()]
+    return cleaned, problems
+
+
+def make_chunk_packs(pending, token_budget, max_chunks):
+    """
+    Groups consecutive (idx, chunk) pairs into packs of at most `max_chunks` whose
+    estimated prompt + answer tokens stay within `token_budget`.
+    A chunk that alone exceeds the budget gets a pack of its own.
+    """
+    packs, current, current_tokens = [], [], 0
+    for idx, chunk in pending:
+        tokens = estimate_tokens(str(chunk)) + _PACK_OUTPUT_TOKENS_PER_CHUNK
+        if current and (len(current) >= max_chunks or current_tokens + tokens > token_budget):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append((idx, chunk))
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def build_chapter_prompt(title) -> str:
+    return (
+        f"Here is the title of a chapter: '{title}'. "
+        f"Please provide a concise summary (around 50 words), a 3-5 bullet point outline, "
+        f"and 2 relevant, contextual questions about this chapter's likely themes. "
+        f"Strictly return ONLY a valid JSON object with keys: 'ChapterSummary', 'ChapterOutline' (list of strings), and 'ChapterQuestions' (list of strings)."
+        f"Example: {{\"ChapterSummary\": \"Summary text...\", \"ChapterOutline\": [\"Point 1\", \"Point 2\"], \"ChapterQuestions\": [\"Question 1?\", \"Question 2?\"]}}"
+    )
+
+
+def build_chunk_prompt(chunk) -> str:
+    return (
+         f"Analyze the following text chunk:\n---START CHUNK---\n{chunk}\n---END CHUNK---\n\n"
+         f"Based SOLELY on this chunk, provide: \n"
+         f"1. 'Wisdom': A single, concise insight or piece of wisdom (1-2 sentences).\n"
+         f"2. 'Reflections': A brief reflection on the chunk's meaning or implication (1-2 sentences).\n"
+         f"3. 'ChunkOutline': A 3-5 bullet point outline summarizing the key points or flow of the chunk.\n"
+         f"4. 'ChunkQuestions': ONE relevant, contextual question that arises directly from this chunk's content.\n"
+         f"Strictly return ONLY a valid JSON object with keys: 'Wisdom' (string), 'Reflections' (string), 'ChunkOutline' (list of strings), and 'ChunkQuestions' (list containing ONE string question)."
+         f"Example: {{\"Wisdom\": \"Wisdom text...\", \"Reflections\": \"Reflection text...\", \"ChunkOutline\": [\"Point 1\", \"Point 2\"], \"ChunkQuestions\": [\"Question 1?\"]}}"
+    )
+
+
+def build_pack_prompt(pack) -> str:
+    chunk_blocks = "\n\n".join(
+        f"---START CHUNK id={idx}---\n{chunk}\n---END CHUNK id={idx}---" for idx, chunk in pack
+    )
+    return (
+         f"Analyze each of the following {len(pack)} text chunks independently:\n\n{chunk_blocks}\n\n"
+         f"For EACH chunk, based SOLELY on that chunk, provide: \n"
+         f"1. 'Wisdom': A single, concise insight or piece of wisdom (1-2 sentences).\n"
+         f"2. 'Reflections': A brief reflection on the chunk's meaning or implication (1-2 sentences).\n"
+         f"3. 'ChunkOutline': A 3-5 bullet point outline summarizing the key points or flow of the chunk.\n"
+         f"4. 'ChunkQuestions': ONE relevant, contextual question that arises directly from this chunk's content.\n"
+         f"Strictly return ONLY a valid JSON object with key 'results': an array with one object per chunk, each with keys: 'id' (the chunk id), 'Wisdom' (string), 'Reflections' (string), 'ChunkOutline' (list of strings), and 'ChunkQuestions' (list containing ONE string question)."
+         f"Example: {{\"results\": [{{\"id\": {pack[0][0]}, \"Wisdom\": \"Wisdom text...\", \"Reflections\": \"Reflection text...\", \"ChunkOutline\": [\"Point 1\", \"Point 2\"], \"ChunkQuestions\": [\"Question 1?\"]}}]}}"
+    )
+
+
+def build_reask_prompt(prompt: str, problems) -> str:
+    """The original prompt plus what was wrong with the previous answer."""
+    return (
+        f"{prompt}\n\n"
+        f"Your previous answer could not be used ({'; '.join(problems)}). "
+        f"Answer again with ONLY the JSON object described above, with every key present."
+    )
+
+
+def prepare_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Fills NaNs and makes sure every enrichment column exists as a string column."""
+    df.fillna('', inplace=True)
+    for col in NEW_COLUMNS:
+        if col not in df.columns:
+            df[col] = ""
+        df[col] = df[col].astype(str)
+    return df
+
+
+class Enricher:
+    """
+    Calls the chat API (through the pooled adapter from providers.get_chat_provider)
+    for chapter and chunk prompts and writes the results into DataFrames. Chunk
+    prompts run on a thread pool of `max_concurrency` workers; `thread_initializer`
+    runs in each worker (the app uses it to attach the Streamlit script context).
+    Every call is recorded in `telemetry` (a RunTelemetry).
+    Pass `provider` (e.g. a balancer.ProviderPool) to override the adapter picked from
+    `api_url`; model_name/api_url then only namespace the response cache.
+    With `json_mode` (default config.STRUCTURED_OUTPUT) providers are asked for their
+    native JSON output. Answers are repaired locally when possible (json_repair) and
+    checked against CHAPTER_SCHEMA / CHUNK_SCHEMA; only answers that stay broken are
+    asked again, up to config.SCHEMA_REASKS times.
+    With `stream` (default config.STREAMING) answers are streamed; `on_result(idx,
+    result)` is then called from worker threads as each chunk's result is known,
+    including chunks of a pack whose object has arrived while the pack still streams.
+    """
+
+    def __init__(self, model_name, api_url, api_key, max_concurrency=None, pack_chunks=False,
+                 cache=None, notify=None, thread_initializer=None, telemetry=None, provider=None,
+                 json_mode=None, stream=None, on_result=None):
+        self.model_name = model_name
+        self.api_url = api_url
+        self.api_key = api_key
+        self.max_concurrency = max(1, int(max_concurrency or config.MAX_CONCURRENT_REQUESTS))
+        self.pack_chunks = pack_chunks
+        self.cache = cache
+        self.notify = notify or print_notify
+        self.thread_initializer = thread_initializer
+        self.telemetry = telemetry or RunTelemetry()
+        self.provider = provider or get_chat_provider(model_name, api_url, api_key)
+        self.json_mode = config.STRUCTURED_OUTPUT if json_mode is None else json_mode
+        self.stream = config.STREAMING if stream is None else stream
+        self.on_result = on_result
+
+    # --- API access -----------------------------------------------------------
+
+    def call_api(self, prompt: str) -> str:
+        return self._call(prompt)[0]
+
+    def _call(self, prompt: str, items: int = 1, new_listener=None):
+        """
+        Returns (content, CallRecord); the record is already in self.telemetry.
+        When streaming, `new_listener()` is called for every attempt (retries and pool
+        failover) and the callback it returns receives that attempt's answer as it arrives.
+        """
+        record = CallRecord(
+            kind="chat", provider=self.provider.name, model=self.model_name,
+            started_at=time.time(), latency_s=0.0, status=None, items=items,
+        )
+        t0 = time.monotonic()
+        # Previously answered prompts are served from the on-disk cache without any HTTP call.
+        content = self.cache.get(self.api_url, self.model_name, prompt) if self.cache else None
+        if content is not None:
+            record.cached = True
+        else:
+            content = self._call_api_uncached(prompt, record, new_listener)
+            # A partial answer from a stalled stream is used, but not kept for later runs.
+            if self.cache and content and not record.error:
+                self.cache.put(self.api_url, self.model_name, prompt, content)
+        record.latency_s = time.monotonic() - t0
+        self.telemetry.record(record)
+        return content, record
+
+    def _discard_cached(self, prompt: str, raw_content: str) -> None:
+        # Don't serve an unusable response on the next run
+        if self.cache and raw_content:
+            self.cache.discard(self.api_url, self.model_name, prompt)
+
+    def _call_api_uncached(self, prompt: str, record: CallRecord, new_listener=None) -> str:
+        """Calls the provider with retries; fills status/retries/tokens/error into `record`."""
+        notify = self.notify
+        max_retries = 2
+        retry_delay = 3 # seconds
+        for attempt in range(max_retries):
+            record.retries = attempt
+            try:
+                if self.stream:
+                    response = self.provider.stream(prompt, json_mode=self.json_mode, new_listener=new_listener)
+                else:
+                    response = self.provider.complete(prompt, json_mode=self.json_mode)
+                record.provider = response.provider or record.provider
+                record.status = response.status
+                record.prompt_tokens = response.prompt_tokens
+                record.completion_tokens = response.completion_tokens
+                record.first_token_s = response.first_token_s
+                record.error = ""
+                if response.stalled:
+                    # Repair closes the cut-off JSON; whatever is still missing gets re-asked.
+                    record.error = "stream stalled"
+                    notify("warning", f"⚠️ Stream stalled after {len(response.text)} characters; using the partial answer.")
+                return response.text
+            except ProviderError as e:
+                record.status = e.status
+                record.error = str(e)
+                if e.status is not None and e.status < 400:
+                    # The call went through but the body wasn't the expected shape.
+                    notify("warning", f"⚠️ {e}")
+                    return ""
+                if e.status is None:
+                    notify("warning", f"⏳ {e} (attempt {attempt + 1}/{max_retries}). Retrying in {retry_delay}s...")
+                    time.sleep(retry_delay)
+                    continue
+                # With several requests in flight, 429s are expected: back off instead of giving up.
+                if e.status == 429 and attempt < max_retries - 1:
+                    wait = e.retry_after if e.retry_after is not None else retry_delay
+                    notify("warning", f"⏳ Rate limited by API (attempt {attempt + 1}/{max_retries}). Retrying in {wait:.0f}s...")
+                    time.sleep(wait)
+                    continue
+                notify("error", f"❌ API Request Failed (attempt {attempt + 1}/{max_retries}): {e}. Raw Response: {e.body or 'N/A'}")
+                if not e.transient:
+                     notify("error", f"❌ Client-side error ({e.status}). Check API Key, Model Name, or Prompt. Stopping retries.")
+                     return ""
+                if attempt < max_retries - 1:
+                    time.sleep(retry_delay)
+                else:
+                    notify("error", f"❌ API Request Failed after {max_retries} attempts.")
+                    return ""
+            except Exception as e:
+                record.error = str(e)
+                notify("error", f"❌ An unexpected error occurred during API call: {e}")
+                return ""
+        return ""
+
+    # --- Single prompts -------------------------------------------------------
+
+    def _parse_object(self, label: str, raw_content: str, schema: dict, record: CallRecord):
+        """
+        Parses (repairing if needed) a response expected to hold one JSON object and
+        validates it against `schema`. Returns (result, problems); problems is empty
+        when the result is usable. An answer that only parsed once its cut-off end was
+        closed has the _CUT_OFF problem. The repair outcome goes into `record`.
+        """
+        if not raw_content.strip():
+            self.notify("warning", f"⚠️ {label}: Received empty or failed response from API.")
+            return {}, ["empty response"]
+        try:
+            parsed, record.json_repair = parse_json(raw_content)
+        except ValueError as e:
+            self.notify("error", f"❌ {label}: Failed to decode JSON response from API. Error: {e}. Raw Content: '{raw_content}'")
+            return {}, [f"invalid JSON ({e})"]
+        result, problems = validate_result(parsed, schema)
+        if record.json_repair == TRUNCATED:
+            problems = problems + [_CUT_OFF]
+        return result, problems
+
+    def _ask(self, label: str, prompt: str, schema: dict) -> dict:
+        """
+        Sends `prompt` and returns the validated result. An answer that is still
+        unusable after local repair is asked again with the problems spelled out;
+        failed API calls are not (they were already retried). A cut-off answer is asked
+        again too, and only used (never cached) if no complete one arrives.
+        Returns {} on failure.
+        """
+        raw_content, record = self._call(prompt)
+        result, problems = self._parse_object(label, raw_content, schema, record)
+        record.parse_ok = not problems
+        if not problems:
+            return result
+        self._discard_cached(prompt, raw_content)
+        salvaged = result if problems == [_CUT_OFF] else {}
+
+        reasks = config.SCHEMA_REASKS if raw_content else 0
+        for attempt in range(reasks):
+            self.notify("warning", f"⚠️ {label}: unusable answer ({'; '.join(problems)}), asking again ({attempt + 1}/{reasks}).")
+            reask_prompt = build_reask_prompt(prompt, problems)
+            raw_content, record = self._call(reask_prompt)
+            result, problems = self._parse_object(label, raw_content, schema, record)
+            record.parse_ok = not problems
+            if not problems:
+                # Next run, the original prompt is answered from the cache.
+                if self.cache:
+                    self.cache.put(self.api_url, self.model_name, prompt, raw_content)
+                return result
+            self._discard_cached(reask_prompt, raw_content)
+            if problems == [_CUT_OFF] and not salvaged:
+                salvaged = result
+            if not raw_content:
+                break
+        if salvaged:
+            self.notify("warning", f"⚠️ {label}: using an answer that was cut off; some of it may be missing.")
+        return salvaged
+
+    def enrich_chapter(self, title) -> dict:
+        """Prompts the API for one chapter title and returns the parsed result (empty dict on failure)."""
+        return self._ask(f"Chapter '{title}'", build_chapter_prompt(title), CHAPTER_SCHEMA)
+
+    def enrich_chunk(self, idx, chunk) -> dict:
+        """Prompts the API for one chunk and returns the parsed result (empty dict on failure)."""
+        return self._ask(f"Chunk {idx}", build_chunk_prompt(chunk), CHUNK_SCHEMA)
+
+    def enrich_pack(self, pack) -> dict:
+        """
+        Prompts the API for several chunks at once and returns {idx: result}.
+        The answer may be {"results": [...]} or a bare array. Chunks missing from the
+        answer, or whose entry fails validation, fall back to single-chunk calls. Of a
+        cut-off answer only the entries the model finished are used, and it is not cached.
+        """
+        prompt = build_pack_prompt(pack)
+        new_listener = self._pack_stream_listeners(pack) if self.stream and self.on_result else None
+        raw_content, record = self._call(prompt, items=len(pack), new_listener=new_listener)
+
+        try:
+            parsed, record.json_repair = parse_json(raw_content)
+        except ValueError:
+            parsed = []
+        if record.json_repair == TRUNCATED:
+            # Closing the answer completes its last entry with whatever was cut off.
+            parsed = StreamingItemParser().feed(raw_content)
+        if isinstance(parsed, dict):
+            parsed = parsed.get("results", [])
+        answers = {}
+        if isinstance(parsed, list):
+            for item in parsed:
+                if isinstance(item, dict) and "id" in item:
+                    result, problems = validate_result(item, CHUNK_SCHEMA)
+                    if not problems:
+                        answers[str(item["id"])] = result
+
+        results = {}
+        missing = []
+        for idx, chunk in pack:
+            if str(idx) in answers:
+                results[idx] = answers[str(idx)]
+            else:
+                missing.append((idx, chunk))
+        record.parse_ok = not missing
+        if len(missing) == len(pack) or record.json_repair == TRUNCATED:
+            self._discard_cached(prompt, raw_content)
+        if missing:
+            self.notify("warning", f"⚠️ Pack of chunks {pack[0][0]}-{pack[-1][0]}: {len(missing)}/{len(pack)} answers missing or malformed, retrying them individually.")
+            for idx, chunk in missing:
+                results[idx] = self.enrich_chunk(idx, chunk)
+        return results
+
+    def _pack_stream_listeners(self, pack):
+        """
+        A factory of on_text callbacks reporting each pack item through on_result as soon
+        as it is complete. Each stream attempt gets its own parser, so a retried or failed
+        over stream is not read as the continuation of the one before it.
+        """
+        idx_of = {str(idx): idx for idx, _ in pack}
+        reported = set()
+
+        def _new_listener():
+            parser = StreamingItemParser()
+
+            def _on_text(delta):
+                for item in parser.feed(delta):
+                    if not isinstance(item, dict) or str(item.get("id")) not in idx_of:
+                        continue
+                    result, problems = validate_result(item, CHUNK_SCHEMA)
+                    idx = idx_of[str(item["id"])]
+                    if not problems and idx not in reported:
+                        reported.add(idx)
+                        self.on_result(idx, result)
+
+            return _on_text
+
+        return _new_listener
+
+    def _enrich_unit(self, unit) -> dict:
+        if len(unit) == 1:
+            idx, chunk = unit[0]
+            results = {idx: self.enrich_chunk(idx, chunk)}
+        else:
+            results = self.enrich_pack(unit)
+        if self.on_result:
+            for idx, result in results.items():
+                self.on_result(idx, result)
+        return results
+
+    # --- DataFrames -----------------------------------------------------------
+
+    def enrich_frame(self, df: pd.DataFrame, progress=None, chapter_results=None) -> pd.DataFrame:
+        """
+        Enriches `df` in place by chapter & chunk and returns it. Rows that already have
+        a ChapterSummary / Wisdom are left alone. `progress(done, total)` is called as work
+        completes. `chapter_results` (title -> parsed result) lets callers that process a
+        book in several frames reuse chapter answers; new results are added to it.
+        Results are gathered in per-column Python lists and written to `df` once at the
+        end, and chapters are resolved through one groupby, so bookkeeping stays linear.
+        """
+        notify = self.notify
+        prepare_columns(df)
+        if chapter_results is None:
+            chapter_results = {}
+
+        # Column buffers: filled by position, assigned back to df in one go.
+        buffers = {col: df[col].tolist() for col in NEW_COLUMNS}
+
+        chapter_rows = {}
+        if "Detected Title" in df.columns:
+            titles = df["Detected Title"].astype(str)
+            groups = titles.groupby(titles, sort=False).indices  # title -> row positions
+            chapter_rows = {title: positions for title, positions in groups.items() if title}
+        else:
+            notify("warning", "⚠️ 'Detected Title' column not found for chapter processing.")
+
+        total_operations = len(chapter_rows) + len(df)
+        operations_done = 0
+
+        def _report():
+            if progress:
+                progress(operations_done, total_operations)
+
+        notify("info", "ℹ️ Starting Chapter Enrichment...")
+        # 3) Chapter‐level enrichment
+        summaries = buffers["ChapterSummary"]
+        for title, positions in chapter_rows.items():
+            if title in chapter_results:
+                result = chapter_results[title]
+            elif not summaries[positions[0]] == "":
+                 operations_done += 1
+                 _report()
+                 continue
+            else:
+                notify("write", f"⏳ Processing Chapter: '{title}'")
+                result = self.enrich_chapter(title)
+                if result:
+                    chapter_results[title] = result
+
+            summary = str(result.get("ChapterSummary", ""))
+            outline = json.dumps(result.get("ChapterOutline", []))
+            questions = json.dumps(result.get("ChapterQuestions", []))
+            for pos in positions:
+                summaries[pos] = summary
+                buffers["ChapterOutline"][pos] = outline
+                buffers["ChapterQuestions"][pos] = questions
+
+            operations_done += 1
+            _report()
+
+        notify("info", "ℹ️ Starting Chunk Enrichment...")
+        # 4) Chunk‐level enrichment
+        if "Text Chunk" not in df.columns:
+            notify("error", "❌ Cannot perform chunk enrichment because 'Text Chunk' column is missing.")
+            self._flush_buffers(df, buffers)
+            return df
+
+        labels = df.index.tolist()
+        chunks = df["Text Chunk"].tolist()
+        wisdom = buffers["Wisdom"]
+        pending = []
+        position_of = {}
+        for pos, (idx, chunk) in enumerate(zip(labels, chunks)):
+            if not wisdom[pos] == "":
+                operations_done += 1
+                continue
+            if not chunk or pd.isna(chunk):
+                operations_done += 1
+                continue
+            pending.append((idx, chunk))
+            position_of[idx] = pos
+        _report()
+
+        if self.pack_chunks:
+            units = make_chunk_packs(pending, config.CHUNK_PACK_TOKEN_BUDGET, config.CHUNK_PACK_MAX_CHUNKS)
+        else:
+            units = [[item] for item in pending]
+
+        notify("write", f"⏳ Enriching {len(pending)} chunks in {len(units)} requests with up to {self.max_concurrency} in flight...")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, initializer=self.thread_initializer) as executor:
+            futures = [(unit, executor.submit(self._enrich_unit, unit)) for unit in units]
+
+            # Collect in submission order so results land in row order.
+            for unit, future in futures:
+                while True:
+                    try:
+                        unit_results = future.result(timeout=0.5)
+                        break
+                    except FutureTimeout:
+                        _report()  # Keeps live views refreshing while an earlier unit is still running
+                for idx, _ in unit:
+                    result = unit_results.get(idx, {})
+                    pos = position_of[idx]
+                    wisdom[pos]                    = str(result.get("Wisdom", ""))
+                    buffers["Reflections"][pos]    = str(result.get("Reflections", ""))
+                    buffers["ChunkOutline"][pos]   = json.dumps(result.get("ChunkOutline", []))
+                    buffers["ChunkQuestions"][pos] = json.dumps(result.get("ChunkQuestions", []))
+                    operations_done += 1
+                self.telemetry.add_rows(len(unit))
+                _report()
+
+        self._flush_buffers(df, buffers)
+        return df
+
+    @staticmethod
+    def _flush_buffers(df: pd.DataFrame, buffers: dict) -> None:
+        for col, values in buffers.items():
+            df[col] = values
+
+
+def _fingerprint(path: str) -> dict:
+    """Size plus a hash of the whole input, so any edit to the book invalidates the checkpoint."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return {"size": os.path.getsize(path), "sha256": digest.hexdigest()}
+
+
+class CheckpointJournal:
+    """
+    Append-only JSON-lines journal next to the output file. Each line is fsynced, so
+    after a crash the last complete "commit" record says how many input rows are safely
+    in the output and at which byte offset the output's committed part ends.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        state = {"input": None, "rows_done": 0, "offset": 0, "chapters": {}}
+        if not os.path.exists(self.path):
+            return state
+        pending_chapters = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Torn final line from a crash; everything before it is valid.
+                event = record.get("event")
+                if event == "start":
+                    state["input"] = record["input"]
+                elif event == "chapter":
+                    pending_chapters[record["title"]] = record["result"]
+                elif event == "commit":
+                    state["rows_done"] = record["rows_done"]
+                    state["offset"] = record["offset"]
+                    state["chapters"].update(pending_chapters)
+                    pending_chapters = {}
+        return state
+
+    def append(self, *records) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def enrich_csv_file(input_path, output_path, enricher, block_size=200, encoding=None,
+                    restart=False, progress=None, should_stop=None) -> int:
+    """
+    Streams `input_path` through `enricher` block by block into `output_path`, resuming
+    from the checkpoint journal unless `restart` is set. `progress(rows_done)` is called
+    after each committed block; returning early when `should_stop()` is true leaves a
+    resumable checkpoint. Returns the number of input rows committed to the output.
+    """
+    journal = CheckpointJournal(output_path + ".journal")
+    fingerprint = _fingerprint(input_path)
+    state = journal.load() if not restart else None
+
+    if state and state["input"] is not None and state["input"] != fingerprint:
+        raise ValueError(
+            f"{journal.path} belongs to a different input file; pass --restart to start over."
+        )
+    if not state or state["input"] is None:
+        for path in (output_path, journal.path):
+            if os.path.exists(path):
+                os.remove(path)
+        journal.append({"event": "start", "input": fingerprint})
+        state = {"input": fingerprint, "rows_done": 0, "offset": 0, "chapters": {}}
+
+    rows_done, offset = state["rows_done"], state["offset"]
+    chapter_results = state["chapters"]
+    if rows_done:
+        enricher.notify("info", f"ℹ️ Resuming after {rows_done} committed rows.")
+
+    # The committed part of the output must still be there; truncate() would pad a
+    # missing or shortened file with NUL bytes and report the rows as done.
+    output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if output_size < offset:
+        raise ValueError(
+            f"{output_path} is shorter ({output_size} bytes) than its checkpoint ({offset} bytes); "
+            f"pass --restart to start over."
+        )
+
+    if encoding is None:
+        encoding, confidence = detect_encoding(input_path)
+        if confidence < LOW_CONFIDENCE:
+            enricher.notify(
+                "warning",
+                f"⚠️ Guessed encoding {encoding} with low confidence ({confidence:.2f}); "
+                f"pass --encoding if the text looks wrong.",
+            )
+
+    # Drop whatever a crashed run appended after its last commit.
+    with open(output_path, "ab") as out:
+        out.truncate(offset)
+
+    rows_seen = 0
+    columns = None
+    for block, bad_rows in iter_csv_blocks(input_path, block_size, encoding):
+        if bad_rows and rows_seen + len(block) > rows_done:
+            enricher.notify("warning", f"⚠️ Skipped malformed rows: {'; '.join(bad_rows)}")
+        block_start = rows_seen
+        rows_seen += len(block)
+        if rows_seen <= rows_done:
+            continue
+        if should_stop and should_stop():
+            break
+        if block_start < rows_done:
+            block = block.iloc[rows_done - block_start:].copy()
+
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in block.columns]
+        if missing_columns:
+            raise ValueError(f"Input is missing the required column(s): {', '.join(missing_columns)}")
+
+        known_titles = set(chapter_results)
+        enricher.enrich_frame(block, chapter_results=chapter_results)
+        if columns is None:
+            columns = list(block.columns) + [col for col in NEW_COLUMNS if col not in block.columns]
+
+        with open(output_path, "a", encoding="utf-8", newline="") as out:
+            block[columns].to_csv(out, header=(offset == 0), index=False)
+            out.flush()
+            os.fsync(out.fileno())
+            offset = out.tell()
+
+        rows_done += len(block)
+        new_chapters = [
+            {"event": "chapter", "title": title, "result": result}
+            for title, result in chapter_results.items() if title not in known_titles
+        ]
+        journal.append(*new_chapters, {"event": "commit", "rows_done": rows_done, "offset": offset})
+        if progress:
+            progress(rows_done)
+
+    return rows_done
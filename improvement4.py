@@ -1,28 +1,242 @@
+import io
 import pandas as pd
-import openai
+import numpy as np
 import json
+import random
+import re
+import time
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import config
+from providers import ProviderError, get_embedding_provider
+from telemetry import CallRecord
+from embedding_store import get_embedding_store
+from text_utils import estimate_tokens, normalize_text, text_hash
 
-def generate_chunk_embeddings(uploaded_file, embedding_model, embedding_api_url, api_key):
+# How a 400 says the input is over the model's limit ("maximum context length", "too many tokens"...).
+_TOO_LARGE_RE = re.compile(r"token|too (long|large)|length|exceed", re.IGNORECASE)
+
+
+def make_embedding_batches(texts, max_items, max_tokens):
+    """
+    Splits `texts` into contiguous (start, end) ranges holding at most `max_items`
+    texts and roughly `max_tokens` estimated tokens. A single oversized text still
+    gets a batch of its own.
+    """
+    batches = []
+    start, batch_tokens = 0, 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if i > start and (i - start >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append((start, i))
+            start, batch_tokens = i, 0
+        batch_tokens += tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def _embed_batch(provider, texts, max_retries, telemetry=None):
+    """Embeds one batch, retrying transient failures with jittered exponential backoff."""
+    record = CallRecord(
+        kind="embedding", provider=provider.name, model=provider.model_name,
+        started_at=time.time(), latency_s=0.0, status=None, items=len(texts),
+    )
+    t0 = time.monotonic()
+    try:
+        for attempt in range(max_retries):
+            record.retries = attempt
+            try:
+                response = provider.embed(texts)
+                record.status, record.prompt_tokens, record.error = response.status, response.prompt_tokens, ""
+                return response.vectors
+            except ProviderError as e:
+                record.status, record.error = e.status, str(e)
+                if not e.transient or attempt == max_retries - 1:
+                    raise
+                backoff = min(2 ** attempt, 30) + random.uniform(0, 1)
+                time.sleep(max(backoff, e.retry_after or 0))
+    finally:
+        record.latency_s = time.monotonic() - t0
+        if telemetry is not None:
+            telemetry.record(record)
+
+
+def _input_too_large(error: ProviderError) -> bool:
+    """Whether the API rejected the request because an input is over the model's limit."""
+    if error.status == 413:
+        return True
+    return error.status == 400 and bool(_TOO_LARGE_RE.search(error.body or str(error)))
+
+
+def _embed_or_split(provider, texts, max_retries, telemetry=None):
+    """
+    Embeds `texts` like _embed_batch, but when the API says an input is too large (413,
+    or a 400 naming a token/length limit) the batch is split in halves until the
+    offending texts are isolated. Any other error fails the batch once, as it is.
+    Returns one vector per text, None for texts rejected on their own.
+    """
+    try:
+        return _embed_batch(provider, texts, max_retries, telemetry)
+    except ProviderError as e:
+        if not _input_too_large(e):
+            raise
+        if len(texts) == 1:
+            return [None]
+        mid = len(texts) // 2
+        return (_embed_or_split(provider, texts[:mid], max_retries, telemetry)
+                + _embed_or_split(provider, texts[mid:], max_retries, telemetry))
+
+
+def embed_texts(provider, texts, telemetry=None, progress=None, notify=None, store=None, should_stop=None):
+    """
+    Embeds `texts` in token-bounded batches sent EMBEDDING_MAX_CONCURRENCY at a time.
+    Texts are normalized (NFC, collapsed whitespace) and deduplicated by hash, so each
+    unique text is embedded once; with a `store` (embedding_store.EmbeddingStore),
+    vectors from earlier runs are reused and new ones saved.
+    Returns (embeddings, failed_rows): one vector per text, None where its batch failed,
+    the API rejected that text, or the text is blank.
+    `progress(done_batches, total_batches)` and `notify(level, message)` are optional
+    hooks, so this runs the same with or without Streamlit. When `should_stop()` turns
+    true, batches not yet started are dropped and their rows count as failed.
+    """
+    hashes = []
+    unique = {}
+    for text in texts:
+        normalized = normalize_text(text)
+        key = text_hash(normalized) if normalized else None
+        hashes.append(key)
+        if key is not None:
+            unique.setdefault(key, normalized)
+
+    vectors = store.get_many(provider.model_name, unique) if store is not None else {}
+    vectors = {key: vec.tolist() for key, vec in vectors.items()}
+    missing = [key for key in unique if key not in vectors]
+    missing_texts = [unique[key] for key in missing]
+    batches = make_embedding_batches(missing_texts, config.EMBEDDING_BATCH_SIZE, config.EMBEDDING_BATCH_MAX_TOKENS)
+
+    if notify:
+        notify("write", f"⏳ {len(texts)} chunks, {len(unique)} unique texts, {len(vectors)} already in the "
+                        f"embedding store; embedding {len(missing)} in {len(batches)} batches...")
+    with ThreadPoolExecutor(max_workers=max(1, config.EMBEDDING_MAX_CONCURRENCY)) as executor:
+        futures = {
+            executor.submit(_embed_or_split, provider, missing_texts[start:end], config.EMBEDDING_MAX_RETRIES, telemetry): (start, end)
+            for start, end in batches
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, end = futures[future]
+            try:
+                embedded = [(key, vec) for key, vec in zip(missing[start:end], future.result()) if vec is not None]
+                vectors.update(embedded)
+                if store is not None:
+                    store.put_many(provider.model_name, embedded)
+                rejected = (end - start) - len(embedded)
+                if rejected and notify:
+                    notify("warning", f"⚠️ The embeddings API rejected {rejected} chunk text(s) on their own "
+                                      f"as over the model's input limit; the rest of their batch was kept.")
+            except Exception as e:
+                if notify:
+                    notify("error", f"❌ Embedding batch for unique texts {start}-{end - 1} failed: {e}")
+            if progress:
+                progress(done, len(batches))
+            if should_stop and should_stop():
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    embeddings = [vectors.get(key) if key is not None else None for key in hashes]
+    failed_rows = sum(1 for key, vec in zip(hashes, embeddings) if key is not None and vec is None)
+    if telemetry is not None:
+        telemetry.add_rows(len(embeddings) - embeddings.count(None))
+    return embeddings, failed_rows
+
+
+def embeddings_to_matrix(embeddings):
+    """
+    Packs per-row vectors (None for rows without one) into a contiguous float32 matrix.
+    Returns (row_ids, matrix) where row_ids[i] is the CSV row position of matrix[i].
+    """
+    row_ids = np.array([i for i, vec in enumerate(embeddings) if vec is not None], dtype=np.int64)
+    if len(row_ids) == 0:
+        return row_ids, np.zeros((0, 0), dtype=np.float32)
+    matrix = np.array([embeddings[i] for i in row_ids], dtype=np.float32)
+    return row_ids, matrix
+
+
+def export_embeddings_npz(row_ids, matrix) -> bytes:
+    """
+    Serializes the matrix as an uncompressed .npz holding `embeddings` (float32, n x dim)
+    and `row_ids` (int64). Members are stored raw, so after unzipping,
+    `np.load("embeddings.npy", mmap_mode="r")` maps the vectors without copying.
+    """
+    buf = io.BytesIO()
+    np.savez(buf, embeddings=matrix, row_ids=row_ids)
+    return buf.getvalue()
+
+
+def export_embeddings_parquet(row_ids, matrix) -> bytes:
+    """
+    Serializes the matrix as Parquet with a `row_id` column and a fixed-size float32
+    list column `embedding`. Requires the optional `pyarrow` package.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dim = matrix.shape[1] if matrix.ndim == 2 else 0
+    values = pa.array(np.ascontiguousarray(matrix, dtype=np.float32).ravel(), type=pa.float32())
+    table = pa.table({
+        "row_id": pa.array(row_ids, type=pa.int64()),
+        "embedding": pa.FixedSizeListArray.from_arrays(values, dim),
+    })
+    buf = io.BytesIO()
+    pq.write_table(table, buf)
+    return buf.getvalue()
+
+
+def generate_chunk_embeddings(uploaded_file, embedding_model, embedding_api_url, api_key, return_matrix=False,
+                              telemetry=None):
     """
     Reads enriched CSV, generates embeddings for 'TEXT CHUNK', returns DataFrame.
+    Texts are embedded in token-bounded batches dispatched concurrently; rows of a
+    batch that still fails after retries are left with an empty 'Embedding'.
+    With return_matrix=True, returns (df, row_ids, matrix) where matrix is the float32
+    embedding matrix and row_ids maps its rows back to the CSV rows.
+    Each batch request is recorded in `telemetry` (a RunTelemetry) when given.
+    Duplicate chunk texts are embedded once, and vectors are reused across runs from
+    the embedding store (config.EMBEDDING_STORE_*).
     """
     if uploaded_file is None:
-        return None
+        return (None, None, None) if return_matrix else None
 
     try:
         df = pd.read_csv(uploaded_file)
     except Exception as e:
         st.error(f"❌ Failed to read CSV for embeddings: {e}")
-        return None
+        return (None, None, None) if return_matrix else None
 
     if "TEXT CHUNK" not in df:
         st.error("❌ Missing 'TEXT CHUNK' column")
-        return None
+        return (None, None, None) if return_matrix else None
 
-    openai.api_key = api_key
+    provider = get_embedding_provider(embedding_model, embedding_api_url, api_key)
     texts = df["TEXT CHUNK"].astype(str).tolist()
-    resp = openai.Embedding.create(model=embedding_model, input=texts)
-    df["Embedding"] = [item["embedding"] for item in resp.data]
-    df["Embedding"] = df["Embedding"].apply(json.dumps)
+
+    progress_bar = st.progress(0)
+    store = get_embedding_store()
+    embeddings, failed_rows = embed_texts(
+        provider, texts, telemetry=telemetry, store=store,
+        progress=lambda done, total: progress_bar.progress(done / total),
+        notify=lambda level, message: getattr(st, level)(message),
+    )
+
+    if store is not None:
+        stats = store.stats()
+        st.caption(f"♻️ Embedding store: {stats['hits']} hits, {stats['misses']} misses this session, "
+                   f"{stats['entries']} vectors ({stats['bytes'] / 1e6:.1f} MB) on disk")
+    if failed_rows:
+        st.warning(f"⚠️ {failed_rows} rows have no embedding; re-run to fill them in.")
+    df["Embedding"] = [json.dumps(vec) if vec is not None else "" for vec in embeddings]
+    if return_matrix:
+        row_ids, matrix = embeddings_to_matrix(embeddings)
+        return df, row_ids, matrix
     return df
@@ -0,0 +1,300 @@
+"""
+Background enrichment/embedding jobs that outlive Streamlit reruns.
+
+Each job gets a directory under config.JOBS_DIR:
+
+    jobs/<job_id>/input.csv      the uploaded book
+    jobs/<job_id>/spec.json      kind and parameters (never the API key)
+    jobs/<job_id>/status.json    state, progress and telemetry summary, rewritten atomically
+    jobs/<job_id>/cancel         flag file; the worker stops at its next checkpoint
+    jobs/<job_id>/output.csv     results (plus output.csv.journal / embeddings.npz)
+    jobs/<job_id>/report.json    per-call run report
+
+Jobs run in a process pool (config.JOB_WORKERS processes), so several books are
+processed in parallel, each with its own connections and enrichment thread pool.
+Enrichment goes through enrichment.enrich_csv_file, so a cancelled or interrupted job resumes
+from its last committed block; embedding jobs resume through the embedding store.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import config
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, INTERRUPTED = (
+    "queued", "running", "done", "failed", "cancelled", "interrupted"
+)
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when the job's cancel flag is set."""
+
+
+def _write_json(path: str, data: dict) -> None:
+    """Writes `data` to `path` atomically, so readers never see a half-written file."""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class _JobContext:
+    """Worker-side view of a job directory: status updates and the cancel flag."""
+
+    def __init__(self, job_dir: str):
+        self.job_dir = job_dir
+        self.status = _read_json(self.path("status.json")) or {}
+        # Enrichment threads report warnings concurrently with the progress updates.
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.job_dir, name)
+
+    def update(self, **fields) -> None:
+        with self._lock:
+            self.status.update(fields, updated_at=time.time())
+            _write_json(self.path("status.json"), self.status)
+
+    def cancelled(self) -> bool:
+        return os.path.exists(self.path("cancel"))
+
+    def notify(self, level: str, message: str) -> None:
+        if level in ("warning", "error"):
+            self.update(message=message)
+
+
+def _run_enrichment(job: _JobContext, spec: dict, api_key: str, telemetry) -> None:
+    from balancer import PoolMember, build_pool, load_pool_spec
+    from enrichment import Enricher, enrich_csv_file
+    from llm_cache import get_response_cache
+    from providers import get_chat_provider
+
+    pool = None
+    if spec.get("use_pool"):
+        own = PoolMember(get_chat_provider(spec["model_name"], spec["api_url"], api_key), label=spec["label"])
+        pool = build_pool(load_pool_spec(), [own])
+    enricher = Enricher(
+        pool.model_name if pool else spec["model_name"], pool.api_url if pool else spec["api_url"], api_key,
+        max_concurrency=spec.get("max_concurrency"),
+        pack_chunks=spec.get("pack_chunks", False),
+        cache=get_response_cache(),
+        notify=job.notify,
+        telemetry=telemetry,
+        provider=pool,
+        stream=spec.get("stream", False),
+    )
+    rows_done = enrich_csv_file(
+        job.path("input.csv"), job.path("output.csv"), enricher,
+        block_size=spec.get("block_size", config.JOB_BLOCK_SIZE),
+        progress=lambda rows: job.update(rows_done=rows, summary=telemetry.summary()),
+        should_stop=job.cancelled,
+    )
+    if job.cancelled():
+        raise JobCancelled(f"Stopped after {rows_done} committed rows")
+    job.update(rows_done=rows_done)
+
+
+def _run_embeddings(job: _JobContext, spec: dict, api_key: str, telemetry) -> None:
+    import pandas as pd
+
+    from embedding_store import get_embedding_store
+    from improvement4 import embed_texts, embeddings_to_matrix, export_embeddings_npz
+    from providers import get_embedding_provider
+
+    df = pd.read_csv(job.path("input.csv"))
+    if "TEXT CHUNK" not in df:
+        raise ValueError("Missing 'TEXT CHUNK' column")
+    texts = df["TEXT CHUNK"].astype(str).tolist()
+    job.update(rows_total=len(texts))
+
+    def _progress(done, total):
+        job.update(batches_done=done, batches_total=total, summary=telemetry.summary())
+
+    provider = get_embedding_provider(spec["model_name"], spec["api_url"], api_key)
+    embeddings, failed_rows = embed_texts(
+        provider, texts, telemetry=telemetry, progress=_progress, notify=job.notify,
+        store=get_embedding_store(), should_stop=job.cancelled,
+    )
+    if job.cancelled():
+        # Finished batches are already in the embedding store, so a resume skips them.
+        raise JobCancelled(f"Stopped with {len(texts) - failed_rows} of {len(texts)} rows embedded")
+    df["Embedding"] = [json.dumps(vec) if vec is not None else "" for vec in embeddings]
+    df.to_csv(job.path("output.csv"), index=False)
+    row_ids, matrix = embeddings_to_matrix(embeddings)
+    with open(job.path("embeddings.npz"), "wb") as f:
+        f.write(export_embeddings_npz(row_ids, matrix))
+    job.update(rows_done=len(texts) - failed_rows, failed_rows=failed_rows)
+
+
+_RUNNERS = {"enrichment": _run_enrichment, "embeddings": _run_embeddings}
+
+
+def run_job(job_dir: str, api_key: str) -> str:
+    """Worker-process entry point: runs the job in `job_dir` and returns its final state."""
+    from telemetry import RunTelemetry
+
+    job = _JobContext(job_dir)
+    spec = _read_json(job.path("spec.json"))
+    if job.cancelled():
+        job.update(state=CANCELLED, message="Cancelled before it started")
+        return CANCELLED
+    telemetry = RunTelemetry(label=spec.get("label", ""))
+    job.update(state=RUNNING, pid=os.getpid(), started_at=time.time(), message="")
+    try:
+        _RUNNERS[spec["kind"]](job, spec, api_key, telemetry)
+        state, message = DONE, ""
+    except JobCancelled as e:
+        state, message = CANCELLED, str(e)
+    except Exception as e:
+        state, message = FAILED, f"{type(e).__name__}: {e}"
+    with open(job.path("report.json"), "w", encoding="utf-8") as f:
+        f.write(telemetry.to_json())
+    job.update(state=state, message=message, summary=telemetry.summary(), finished_at=time.time())
+    return state
+
+
+class JobManager:
+    """Submits jobs to a worker process pool and reads their state back from disk."""
+
+    def __init__(self, jobs_dir: str = None, max_workers: int = None):
+        self.jobs_dir = jobs_dir or config.JOBS_DIR
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._max_workers = max_workers or config.JOB_WORKERS
+        self._executor = self._new_executor()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # "spawn" keeps workers independent of the server's threads and open connections.
+        return ProcessPoolExecutor(max_workers=self._max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def submit(self, kind: str, input_data: bytes, name: str, api_key: str, **params) -> str:
+        """Queues a `kind` ("enrichment" or "embeddings") job for `input_data`; returns its id."""
+        if kind not in _RUNNERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, "input.csv"), "wb") as f:
+            f.write(input_data)
+        _write_json(os.path.join(job_dir, "spec.json"), dict(params, kind=kind, name=name))
+        _write_json(os.path.join(job_dir, "status.json"), {
+            "job_id": job_id, "kind": kind, "name": name, "state": QUEUED,
+            "created_at": time.time(), "updated_at": time.time(), "rows_done": 0, "message": "",
+        })
+        self._start(job_id, api_key)
+        return job_id
+
+    def _start(self, job_id: str, api_key: str) -> None:
+        with self._lock:
+            try:
+                future = self._executor.submit(run_job, self.job_dir(job_id), api_key)
+            except BrokenProcessPool:
+                self._replace_broken_executor()
+                future = self._executor.submit(run_job, self.job_dir(job_id), api_key)
+            self._futures[job_id] = future
+
+    def _replace_broken_executor(self) -> None:
+        """
+        A worker that dies (out of memory, a crash) breaks the whole pool: its jobs and
+        every job queued with it are marked interrupted, so they can be resumed, and a
+        new pool takes further jobs. Called with the lock held.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for job_id in list(self._futures):
+            path = os.path.join(self.job_dir(job_id), "status.json")
+            status = _read_json(path) or {}
+            if status.get("state") in ACTIVE_STATES:
+                _write_json(path, dict(status, state=INTERRUPTED, updated_at=time.time(),
+                                       message="The worker process died (out of memory?); resume to continue"))
+            del self._futures[job_id]
+        self._executor = self._new_executor()
+
+    def resume(self, job_id: str, api_key: str) -> None:
+        """Re-queues a cancelled, failed or interrupted job; enrichment continues from its checkpoint."""
+        job_dir = self.job_dir(job_id)
+        cancel_flag = os.path.join(job_dir, "cancel")
+        if os.path.exists(cancel_flag):
+            os.remove(cancel_flag)
+        status = _read_json(os.path.join(job_dir, "status.json")) or {}
+        _write_json(os.path.join(job_dir, "status.json"), dict(status, state=QUEUED, message="", updated_at=time.time()))
+        self._start(job_id, api_key)
+
+    def cancel(self, job_id: str) -> None:
+        """Asks the job to stop; a queued job never starts, a running one stops at its next checkpoint."""
+        open(os.path.join(self.job_dir(job_id), "cancel"), "a").close()
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            status = self.status(job_id)
+            _write_json(os.path.join(self.job_dir(job_id), "status.json"),
+                        dict(status, state=CANCELLED, message="Cancelled before it started", updated_at=time.time()))
+
+    def delete(self, job_id: str) -> None:
+        """Removes an inactive job and its files."""
+        if self.status(job_id).get("state") in ACTIVE_STATES:
+            raise ValueError(f"Job {job_id} is still active; cancel it first")
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def status(self, job_id: str) -> dict:
+        status = _read_json(os.path.join(self.job_dir(job_id), "status.json")) or {"job_id": job_id, "state": FAILED}
+        with self._lock:
+            future = self._futures.get(job_id)
+        # Active on disk but unknown to this process: its worker died with an earlier server.
+        if status.get("state") in ACTIVE_STATES and (future is None or future.done()):
+            status["state"] = INTERRUPTED
+        return status
+
+    def list_jobs(self) -> list:
+        """Statuses of every job on disk, newest first."""
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        job_ids = sorted(
+            (d for d in os.listdir(self.jobs_dir) if os.path.isfile(os.path.join(self.jobs_dir, d, "status.json"))),
+            reverse=True,
+        )
+        return [self.status(job_id) for job_id in job_ids]
+
+    def output_path(self, job_id: str, name: str = "output.csv") -> Optional[str]:
+        path = os.path.join(self.job_dir(job_id), name)
+        return path if os.path.exists(path) else None
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def jobs_exist(jobs_dir: str = None) -> bool:
+    """Whether any job is on disk, checked without creating the manager or its worker pool."""
+    jobs_dir = jobs_dir or config.JOBS_DIR
+    if not os.path.isdir(jobs_dir):
+        return False
+    return any(os.path.isfile(os.path.join(jobs_dir, d, "status.json")) for d in os.listdir(jobs_dir))
+
+
+def get_job_manager() -> JobManager:
+    """The process-wide JobManager; module state survives Streamlit reruns."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,274 @@
+"""
+Tolerant parsing of JSON written by language models.
+
+Models wrap answers in prose or markdown fences, leave trailing commas, use single or
+curly quotes, write Python literals, and get cut off mid-object when they hit the
+output limit. `parse_json` first extracts the outermost balanced object/array
+(string-aware, so braces inside values don't confuse it), tries the strict parser,
+and only then rewrites the text: quotes normalized, trailing commas dropped, bare
+True/False/None mapped, and unterminated strings/containers closed. A repaired
+answer is used instead of paying for the call again, but one that had to be closed is
+reported as TRUNCATED: it parses, yet whatever the model did not write is missing.
+"""
+import json
+import re
+from typing import Any, Tuple
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+_OPEN_QUOTES = {'"': '"', "'": "'", "“": "”", "‘": "’"}
+_CLOSERS = {"{": "}", "[": "]"}
+_NUMBER_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+# parse_json outcomes besides "" (the strict parser accepted the text as written).
+REPAIRED = "repaired"     # rewritten into valid JSON, nothing missing
+TRUNCATED = "truncated"   # an unterminated string or container had to be closed
+
+
+def strip_fences(text: str) -> str:
+    """The content of the first markdown code fence (even an unclosed one), else `text`."""
+    match = _FENCE_RE.search(text)
+    return match.group(1).strip() if match else text.strip()
+
+
+def extract_json(text: str) -> str:
+    """
+    The outermost JSON object or array in `text`: from the first '{' or '[' to its
+    matching bracket, skipping brackets inside strings. If the answer was cut off, the
+    rest of the text from the opening bracket is returned. "" when there is none.
+    """
+    text = strip_fences(text)
+    start = next((i for i, ch in enumerate(text) if ch in "{["), None)
+    if start is None:
+        return ""
+    depth, in_string, escaped = 0, False, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def _strip_trailing_comma(out: list) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def _ends_string(text: str, i: int) -> bool:
+    """Whether the quote at text[i] closes its string: only , } ] : or the end may follow it."""
+    j = i + 1
+    while j < len(text) and text[j].isspace():
+        j += 1
+    return j == len(text) or text[j] in ",}]:"
+
+
+def _json_number(token: str) -> str:
+    """A number as JSON spells it: no leading '+', no bare leading or trailing '.'."""
+    sign = "-" if token.startswith("-") else ""
+    token = token.lstrip("+-")
+    if token.startswith("."):
+        token = "0" + token
+    mantissa, e, exponent = token.partition("e") if "e" in token else token.partition("E")
+    if mantissa.endswith("."):
+        mantissa += "0"
+    return sign + mantissa + e + exponent
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites almost-JSON into JSON: single/curly quotes become double quotes, quotes
+    inside strings and raw newlines are escaped, trailing commas are dropped, Python
+    literals are mapped, bare keys are quoted, numbers are normalized, and anything
+    left open at the end is closed.
+    """
+    return _repair(text)[0]
+
+
+def _repair(text: str) -> Tuple[str, bool]:
+    """repair_json, plus whether anything left open at the end had to be closed."""
+    out = []
+    stack = []           # [bracket, expecting_key] per open container
+    quote = None         # closing character of the string being copied, if any
+    last_token = ""      # "string", "value", or the last punctuation character
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if quote is not None:
+            if ch == "\\" and i + 1 < n:
+                nxt = text[i + 1]
+                # \' is not a JSON escape; everything else is kept as written.
+                out.append("'" if nxt == "'" else ch + nxt)
+                i += 2
+                continue
+            if ch == quote and (quote not in "\"'" or _ends_string(text, i)):
+                out.append('"')
+                quote = None
+                last_token = "string"
+            elif ch == quote == "'":
+                out.append(ch)              # an apostrophe, as in 'don't'
+            elif ch == '"':
+                out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\r":
+                out.append("\\r")
+            elif ch == "\t":
+                out.append("\\t")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in _OPEN_QUOTES:
+            quote = _OPEN_QUOTES[ch]
+            out.append('"')
+        elif ch in "{[":
+            stack.append([ch, ch == "{"])
+            out.append(ch)
+            last_token = ch
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            if stack and stack[-1][0] == "{":
+                if stack[-1][1] and last_token == "string":
+                    out.append(": null")        # dangling key
+                elif last_token == ":":
+                    out.append("null")
+            if stack:
+                out.append(_CLOSERS[stack.pop()[0]])
+            last_token = "value"
+        elif ch == ":":
+            if stack:
+                stack[-1][1] = False
+            out.append(ch)
+            last_token = ":"
+        elif ch == ",":
+            if stack and stack[-1][0] == "{":
+                stack[-1][1] = True
+            out.append(ch)
+            last_token = ","
+        elif ch.isdigit() or (ch in "+-." and _NUMBER_RE.match(text, i)):
+            match = _NUMBER_RE.match(text, i)
+            out.append(_json_number(match.group()))
+            last_token = "value"
+            i = match.end()
+            continue
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            if stack and stack[-1][0] == "{" and stack[-1][1]:
+                out.append(json.dumps(word))     # bare key
+                last_token = "string"
+            else:
+                out.append(_LITERALS.get(word, json.dumps(word)))
+                last_token = "value"
+            i = j
+            continue
+        else:
+            out.append(ch)
+            if not ch.isspace():
+                last_token = "value"
+        i += 1
+
+    # Close whatever the model left open (a cut-off answer).
+    truncated = quote is not None or bool(stack)
+    if quote is not None:
+        out.append('"')
+        last_token = "string"
+    while stack:
+        bracket, expecting_key = stack.pop()
+        _strip_trailing_comma(out)
+        if bracket == "{":
+            if expecting_key and last_token == "string":
+                out.append(": null")        # dangling key
+            elif last_token == ":":
+                out.append("null")
+        out.append(_CLOSERS[bracket])
+        last_token = "value"
+    return "".join(out), truncated
+
+
+def parse_json(text: str) -> Tuple[Any, str]:
+    """
+    Parses the JSON object/array in a model answer. Returns (value, repair) where
+    `repair` is "" when the strict parse worked, REPAIRED when the repaired text was
+    used, and TRUNCATED when the repair also had to close a cut-off answer.
+    Raises ValueError when there is no JSON or it cannot be repaired.
+    """
+    candidate = extract_json(text or "")
+    if not candidate:
+        raise ValueError("no JSON object or array found")
+    try:
+        return json.loads(candidate), ""
+    except json.JSONDecodeError:
+        pass
+    repaired, truncated = _repair(candidate)
+    try:
+        return json.loads(repaired), TRUNCATED if truncated else REPAIRED
+    except json.JSONDecodeError as e:
+        raise ValueError(f"unrepairable JSON: {e}") from e
+
+
+class StreamingItemParser:
+    """
+    Incremental scanner for a streamed answer holding an array of objects, either bare
+    or under a key such as {"results": [...]}. `feed(delta)` returns the array items
+    that delta completed, already parsed, so each can be used before the answer ends.
+    Every character is scanned once.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._array_depth = None   # depth inside the first array; -1 once it has closed
+        self._in_string = False
+        self._escaped = False
+        self._item = None          # characters of the object being read, if any
+
+    def feed(self, delta: str) -> list:
+        completed = []
+        for ch in delta:
+            item = self._item
+            if item is not None:
+                item.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._array_depth is None:
+                    self._array_depth = self._depth
+                elif ch == "{" and item is None and self._array_depth and self._depth == self._array_depth + 1:
+                    self._item = [ch]
+            elif ch in "}]":
+                if item is not None and self._depth == self._array_depth + 1:
+                    try:
+                        completed.append(parse_json("".join(item))[0])
+                    except ValueError:
+                        pass
+                    self._item = None
+                self._depth -= 1
+                if self._array_depth and self._depth < self._array_depth:
+                    self._array_depth = -1
+        return completed
@@ -0,0 +1,54 @@
+import hashlib
+
+import config
+from sqlite_cache import SqliteLruCache, shared_cache
+
+
+def cache_key(api_url: str, model_name: str, prompt: str) -> str:
+    """Content address of a prompt: sha256 over provider URL, model and prompt text."""
+    h = hashlib.sha256()
+    for part in (api_url, model_name, prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResponseCache(SqliteLruCache):
+    """
+    On-disk (SQLite) cache of raw LLM responses keyed by `cache_key`.
+    Entries older than `max_age_seconds` are treated as misses, and the least recently
+    used entries are evicted once the stored responses exceed `max_bytes`.
+    Safe to share between the enrichment worker threads.
+    """
+
+    table = "responses"
+    key_columns = (("key", "TEXT"),)
+    value_column = ("response", "TEXT")
+
+    def get(self, api_url: str, model_name: str, prompt: str):
+        """Returns the cached response, or None on a miss (or an expired entry)."""
+        key = (cache_key(api_url, model_name, prompt),)
+        return self._get_many([key]).get(key)
+
+    def put(self, api_url: str, model_name: str, prompt: str, response: str) -> None:
+        """Stores a response, then evicts expired and least recently used entries."""
+        key = (cache_key(api_url, model_name, prompt),)
+        self._put_many([(key, response, len(response.encode("utf-8")))])
+
+    def discard(self, api_url: str, model_name: str, prompt: str) -> None:
+        """Drops an entry, e.g. when its response turned out to be unusable."""
+        self._discard((cache_key(api_url, model_name, prompt),))
+
+
+def get_response_cache(path: str = None):
+    """
+    Returns the process-wide ResponseCache for `path` (config.LLM_CACHE_PATH by default),
+    or None when caching is disabled.
+    """
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    return shared_cache(
+        ResponseCache, path or config.LLM_CACHE_PATH,
+        max_bytes=int(config.LLM_CACHE_MAX_MB * 1024 * 1024),
+        max_age_seconds=config.LLM_CACHE_MAX_AGE_DAYS * 86400,
+    )
@@ -0,0 +1,530 @@
+"""
+Provider adapters for the chat and embedding backends in config.py.
+
+Each adapter owns a persistent, pooled HTTP client (keep-alive `requests.Session`, or an
+HTTP/2 `httpx.Client` when HTTP2_ENABLED is set and httpx[http2] is installed) and maps
+prompts to the backend's request shape and its response back to text/vectors.
+Adapters are cached per (backend, URL, key, model), so every run, thread and Streamlit
+rerun in a process reuses the same warm connections.
+Chat adapters can also stream (server-sent events): `stream()` hands each text delta to
+a callback as it arrives and, once the answer has started, treats a gap longer than
+STREAM_STALL_TIMEOUT as a stall.
+"""
+import codecs
+import json
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import config
+
+
+class ProviderError(Exception):
+    """A failed provider call. `status` is None for timeouts and connection errors."""
+
+    def __init__(self, message: str, status: Optional[int] = None,
+                 retry_after: Optional[float] = None, body: str = ""):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.body = body
+
+    @property
+    def transient(self) -> bool:
+        """Timeouts, dropped connections, rate limits and 5xx are worth retrying."""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class ChatResponse(NamedTuple):
+    text: str
+    status: int
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    provider: Optional[str] = None  # set by balancer.ProviderPool to the member that answered
+    stalled: bool = False           # a stream stopped mid-answer; `text` is what arrived
+    first_token_s: Optional[float] = None  # streaming: seconds until the first text delta
+
+
+class EmbeddingResponse(NamedTuple):
+    vectors: List[List[float]]
+    status: int
+    prompt_tokens: Optional[int] = None
+
+
+# Most bytes taken from the socket per read while streaming; reads return what has arrived.
+_STREAM_READ_BYTES = 8192
+_LINE_END_RE = re.compile(r"\r\n|\r|\n")
+
+
+def _iter_text_lines(chunks) -> Iterator[str]:
+    """Decodes byte chunks as UTF-8 and yields each line (without its ending) once it is complete."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        # A trailing "\r" may be the first half of a "\r\n" split across chunks.
+        cut = len(pending) - 1 if pending.endswith("\r") else len(pending)
+        *lines, rest = _LINE_END_RE.split(pending[:cut])
+        pending = rest + pending[cut:]
+        yield from lines
+    lines = _LINE_END_RE.split(pending + decoder.decode(b"", final=True))
+    yield from (lines[:-1] if lines[-1] == "" else lines)
+
+
+def _retry_after(headers) -> Optional[float]:
+    try:
+        return max(float(headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class _RequestsTransport:
+    """Keep-alive HTTP/1.1 client backed by a pooled requests.Session."""
+
+    def __init__(self, pool_size: int):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, url, payload, headers, timeout):
+        try:
+            r = self.session.post(url, json=payload, headers=headers, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            raise ProviderError(f"Request timed out: {e}") from e
+        except requests.exceptions.RequestException as e:
+            raise ProviderError(f"Request failed: {e}") from e
+        return r.status_code, r.headers, r.text
+
+    def stream_lines(self, url, payload, headers, first_timeout, stall_timeout) -> Iterator:
+        """
+        Yields the response status and headers, then each line of the body as it arrives.
+        The headers and the first line may take `first_timeout`; after that a gap over
+        `stall_timeout` between reads is a stall.
+        """
+        waiting_for = "Request timed out"
+        try:
+            with self.session.post(url, json=payload, headers=headers, stream=True,
+                                   timeout=(first_timeout, first_timeout)) as r:
+                yield r.status_code, r.headers
+                if r.status_code >= 400:
+                    yield r.text
+                    return
+                for line in _iter_text_lines(self._iter_body(r)):
+                    if waiting_for != "Stream stalled":
+                        self._set_read_timeout(r, stall_timeout)
+                        waiting_for = "Stream stalled"
+                    yield line
+        except (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError) as e:
+            raise ProviderError(f"{waiting_for}: {e}") from e
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            raise ProviderError(f"Request failed: {e}") from e
+
+    @staticmethod
+    def _set_read_timeout(r, timeout: float) -> None:
+        """Changes the read timeout of a streaming response's socket (requests has no API for it)."""
+        sock = getattr(getattr(r.raw, "_connection", None), "sock", None)
+        if sock is not None:
+            # urllib3 sets the timeout again when the connection is reused.
+            sock.settimeout(timeout)
+
+    @staticmethod
+    def _iter_body(r) -> Iterator[bytes]:
+        """
+        The body as it arrives. iter_content(None) yields chunked bodies chunk by chunk
+        but reads a body delimited by the connection closing in one go, so those are read
+        with read1, which returns whatever bytes are available.
+        """
+        if r.raw.chunked or not hasattr(r.raw, "read1"):
+            # urllib3 < 2 has no read1; small reads keep a close-delimited body incremental.
+            yield from r.iter_content(chunk_size=None if r.raw.chunked else 1)
+            return
+        while True:
+            data = r.raw.read1(_STREAM_READ_BYTES, decode_content=True)
+            if not data:
+                return
+            yield data
+
+
+class _HttpxTransport:
+    """HTTP/2 client (multiplexes concurrent requests over one connection)."""
+
+    def __init__(self, pool_size: int):
+        import httpx
+
+        self._httpx = httpx
+        self.client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    def post(self, url, payload, headers, timeout):
+        httpx = self._httpx
+        try:
+            r = self.client.post(url, json=payload, headers=headers, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise ProviderError(f"Request timed out: {e}") from e
+        except httpx.HTTPError as e:
+            raise ProviderError(f"Request failed: {e}") from e
+        return r.status_code, r.headers, r.text
+
+    def stream_lines(self, url, payload, headers, first_timeout, stall_timeout) -> Iterator:
+        """
+        Yields the response status and headers, then each line of the body as it arrives.
+        The headers and the first line may take `first_timeout`; after that a gap over
+        `stall_timeout` between reads is a stall.
+        """
+        httpx = self._httpx
+        waiting_for = "Request timed out"
+        try:
+            with self.client.stream("POST", url, json=payload, headers=headers,
+                                    timeout=httpx.Timeout(first_timeout)) as r:
+                yield r.status_code, r.headers
+                if r.status_code >= 400:
+                    yield r.read().decode("utf-8", errors="replace")
+                    return
+                for line in r.iter_lines():
+                    if waiting_for != "Stream stalled":
+                        # httpcore reads the timeout extension before every network read.
+                        r.request.extensions["timeout"]["read"] = stall_timeout
+                        waiting_for = "Stream stalled"
+                    yield line
+        except httpx.TimeoutException as e:
+            raise ProviderError(f"{waiting_for}: {e}") from e
+        except httpx.HTTPError as e:
+            raise ProviderError(f"Request failed: {e}") from e
+
+
+def _iter_sse_data(lines) -> Iterator[str]:
+    """The `data:` payload of each server-sent event (multi-line data joined), until [DONE]."""
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                payload = "\n".join(data)
+                data = []
+                if payload == "[DONE]":
+                    return
+                yield payload
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+    if data and "\n".join(data) != "[DONE]":
+        yield "\n".join(data)
+
+
+def _make_transport(pool_size: int):
+    if config.HTTP2_ENABLED:
+        try:
+            import h2  # noqa: F401  (httpx needs it for http2=True)
+            return _HttpxTransport(pool_size)
+        except ImportError:
+            pass
+    return _RequestsTransport(pool_size)
+
+
+class BaseProvider:
+    """Shared plumbing: pooled transport, POST + status/JSON error mapping."""
+
+    name = "base"
+
+    def __init__(self, api_url: str, api_key: str, model_name: str = "",
+                 pool_size: Optional[int] = None, timeout: Optional[float] = None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.model_name = model_name
+        self.timeout = timeout or config.REQUEST_TIMEOUT
+        self.transport = _make_transport(pool_size or config.HTTP_POOL_MAXSIZE)
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+
+    def _post(self, payload: dict, url: Optional[str] = None):
+        status, headers, body = self.transport.post(url or self.api_url, payload, self._headers(), self.timeout)
+        if status >= 400:
+            raise ProviderError(
+                f"{self.name} API returned HTTP {status}", status=status,
+                retry_after=_retry_after(headers), body=body,
+            )
+        try:
+            return status, json.loads(body)
+        except ValueError as e:
+            raise ProviderError(f"{self.name} API returned invalid JSON: {e}", status=status, body=body) from e
+
+    def _post_stream(self, payload: dict, url: Optional[str] = None) -> Iterator:
+        """
+        POSTs a streaming request. Yields the HTTP status, then each server-sent event
+        payload parsed as JSON. The response may take the full request timeout to start
+        (models that reason first send nothing until then); after that a read gap over
+        STREAM_STALL_TIMEOUT, or a stream that runs past STREAM_MAX_SECONDS, raises
+        ProviderError(status=None).
+        """
+        lines = self.transport.stream_lines(
+            url or self.api_url, payload, self._headers(), self.timeout, config.STREAM_STALL_TIMEOUT,
+        )
+        status, headers = next(lines)
+        if status >= 400:
+            body = next(lines, "")
+            raise ProviderError(
+                f"{self.name} API returned HTTP {status}", status=status,
+                retry_after=_retry_after(headers), body=body,
+            )
+        yield status
+        deadline = time.monotonic() + config.STREAM_MAX_SECONDS
+        for data in _iter_sse_data(lines):
+            if time.monotonic() > deadline:
+                raise ProviderError(f"Stream exceeded {config.STREAM_MAX_SECONDS:.0f}s")
+            try:
+                yield json.loads(data)
+            except ValueError as e:
+                raise ProviderError(f"{self.name} API streamed invalid JSON: {e}", status=status, body=data) from e
+
+
+class ChatProvider(BaseProvider):
+    # Whether complete(..., json_mode=True) asks the API itself for a JSON answer.
+    supports_json_mode = False
+
+    def complete(self, prompt: str, json_mode: bool = False) -> ChatResponse:
+        raise NotImplementedError
+
+    def _stream_events(self, prompt: str, json_mode: bool) -> Iterator:
+        """Yields the HTTP status, then (text_delta, prompt_tokens, completion_tokens) per event."""
+        raise NotImplementedError
+
+    def stream(self, prompt: str, json_mode: bool = False,
+               on_text: Optional[Callable[[str], None]] = None,
+               new_listener: Optional[Callable[[], Callable[[str], None]]] = None) -> ChatResponse:
+        """
+        Like complete(), but streamed: `on_text(delta)` gets each piece of the answer as
+        it arrives. `new_listener()`, when given, creates that callback for this stream,
+        so callers that retry get a fresh listener per attempt. If the stream stalls
+        after some text has arrived, returns what came in with `stalled=True` instead of
+        discarding it.
+        """
+        if new_listener:
+            on_text = new_listener()
+        t0 = time.monotonic()
+        events = self._stream_events(prompt, json_mode)
+        status = next(events)
+        parts, first_token_s = [], None
+        prompt_tokens = completion_tokens = None
+        try:
+            for delta, p_tokens, c_tokens in events:
+                prompt_tokens = p_tokens if p_tokens is not None else prompt_tokens
+                completion_tokens = c_tokens if c_tokens is not None else completion_tokens
+                if delta:
+                    if first_token_s is None:
+                        first_token_s = time.monotonic() - t0
+                    parts.append(delta)
+                    if on_text:
+                        on_text(delta)
+        except ProviderError as e:
+            if e.status is None and parts:
+                return ChatResponse("".join(parts).strip(), status, prompt_tokens, completion_tokens,
+                                    stalled=True, first_token_s=first_token_s)
+            raise
+        return ChatResponse("".join(parts).strip(), status, prompt_tokens, completion_tokens,
+                            first_token_s=first_token_s)
+
+
+class OpenAIChatProvider(ChatProvider):
+    """OpenAI Chat Completions (and compatible APIs)."""
+
+    name = "openai"
+    supports_json_mode = True
+
+    def complete(self, prompt: str, json_mode: bool = False) -> ChatResponse:
+        status, data = self._post(self._payload(prompt, json_mode))
+        try:
+            text = data["choices"][0]["message"]["content"] or ""
+        except (KeyError, IndexError, TypeError):
+            raise ProviderError(f"Unexpected {self.name} response format: {data}", status=status)
+        usage = data.get("usage") or {}
+        return ChatResponse(text.strip(), status, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+    def _payload(self, prompt: str, json_mode: bool) -> dict:
+        payload = {
+            "model": self.model_name,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if json_mode and self.supports_json_mode:
+            # JSON mode guarantees one syntactically valid object (the prompt must mention JSON).
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    def _stream_events(self, prompt: str, json_mode: bool) -> Iterator:
+        payload = dict(self._payload(prompt, json_mode), stream=True, stream_options={"include_usage": True})
+        events = self._post_stream(payload)
+        yield next(events)
+        for event in events:
+            usage = event.get("usage") or {}
+            choices = event.get("choices") or [{}]
+            delta = (choices[0].get("delta") or {}).get("content") or ""
+            yield delta, usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+class DeepSeekChatProvider(OpenAIChatProvider):
+    """DeepSeek speaks the OpenAI Chat Completions format."""
+
+    name = "deepseek"
+
+    @property
+    def supports_json_mode(self) -> bool:
+        # deepseek-reasoner rejects response_format; deepseek-chat supports JSON output.
+        return "reasoner" not in self.model_name
+
+
+class AnthropicChatProvider(ChatProvider):
+    """Anthropic Messages API."""
+
+    name = "anthropic"
+    supports_json_mode = True
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "x-api-key": self.api_key,
+            "anthropic-version": config.ANTHROPIC_VERSION,
+            "Content-Type": "application/json",
+        }
+
+    def _payload(self, prompt: str, json_mode: bool):
+        """Returns (payload, prefill)."""
+        messages = [{"role": "user", "content": prompt}]
+        # No JSON switch in the Messages API: prefilling "{" makes the answer start as an object.
+        prefill = "{" if json_mode else ""
+        if prefill:
+            messages.append({"role": "assistant", "content": prefill})
+        return {"model": self.model_name, "max_tokens": config.ANTHROPIC_MAX_TOKENS, "messages": messages}, prefill
+
+    def complete(self, prompt: str, json_mode: bool = False) -> ChatResponse:
+        payload, prefill = self._payload(prompt, json_mode)
+        status, data = self._post(payload)
+        blocks = data.get("content")
+        if not isinstance(blocks, list):
+            raise ProviderError(f"Unexpected {self.name} response format: {data}", status=status)
+        text = prefill + "".join(block.get("text", "") for block in blocks if block.get("type") == "text")
+        usage = data.get("usage") or {}
+        return ChatResponse(text.strip(), status, usage.get("input_tokens"), usage.get("output_tokens"))
+
+    def _stream_events(self, prompt: str, json_mode: bool) -> Iterator:
+        payload, prefill = self._payload(prompt, json_mode)
+        events = self._post_stream(dict(payload, stream=True))
+        yield next(events)
+        if prefill:
+            yield prefill, None, None
+        for event in events:
+            kind = event.get("type")
+            if kind == "message_start":
+                usage = (event.get("message") or {}).get("usage") or {}
+                yield "", usage.get("input_tokens"), usage.get("output_tokens")
+            elif kind == "content_block_delta":
+                delta = event.get("delta") or {}
+                yield delta.get("text", "") if delta.get("type") == "text_delta" else "", None, None
+            elif kind == "message_delta":
+                yield "", None, (event.get("usage") or {}).get("output_tokens")
+            elif kind == "error":
+                error = event.get("error") or {}
+                # overloaded_error arrives mid-stream with HTTP 200; treat it like a 529.
+                raise ProviderError(f"{self.name} stream error: {error.get('message', event)}",
+                                    status=529 if error.get("type") == "overloaded_error" else 500,
+                                    body=json.dumps(event))
+
+
+class GeminiChatProvider(ChatProvider):
+    """Google Gemini generateContent (the model is part of the URL)."""
+
+    name = "gemini"
+    supports_json_mode = True
+
+    def _headers(self) -> Dict[str, str]:
+        return {"x-goog-api-key": self.api_key, "Content-Type": "application/json"}
+
+    def _payload(self, prompt: str, json_mode: bool) -> dict:
+        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        if json_mode:
+            payload["generationConfig"] = {"responseMimeType": "application/json"}
+        return payload
+
+    def complete(self, prompt: str, json_mode: bool = False) -> ChatResponse:
+        status, data = self._post(self._payload(prompt, json_mode))
+        try:
+            parts = data["candidates"][0]["content"]["parts"]
+        except (KeyError, IndexError, TypeError):
+            raise ProviderError(f"Unexpected {self.name} response format: {data}", status=status)
+        text = "".join(part.get("text", "") for part in parts)
+        usage = data.get("usageMetadata") or {}
+        return ChatResponse(text.strip(), status, usage.get("promptTokenCount"), usage.get("candidatesTokenCount"))
+
+    def _stream_url(self) -> str:
+        base, _, query = self.api_url.partition("?")
+        base = base.replace(":generateContent", ":streamGenerateContent")
+        return f"{base}?{query + '&' if query else ''}alt=sse"
+
+    def _stream_events(self, prompt: str, json_mode: bool) -> Iterator:
+        events = self._post_stream(self._payload(prompt, json_mode), self._stream_url())
+        yield next(events)
+        for event in events:
+            usage = event.get("usageMetadata") or {}
+            try:
+                parts = event["candidates"][0]["content"]["parts"]
+            except (KeyError, IndexError, TypeError):
+                parts = []
+            yield "".join(part.get("text", "") for part in parts), usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+
+
+class OpenAIEmbeddingProvider(BaseProvider):
+    """OpenAI /v1/embeddings (and compatible APIs)."""
+
+    name = "openai-embeddings"
+
+    def embed(self, texts: List[str]) -> EmbeddingResponse:
+        status, data = self._post({"model": self.model_name, "input": texts})
+        try:
+            # Each vector carries its input position; don't rely on response order.
+            items = sorted(data["data"], key=lambda item: item["index"])
+            vectors = [item["embedding"] for item in items]
+        except (KeyError, TypeError):
+            raise ProviderError(f"Unexpected {self.name} response format: {data}", status=status)
+        if len(vectors) != len(texts):
+            raise ProviderError(f"{self.name} returned {len(vectors)} vectors for {len(texts)} inputs", status=status)
+        return EmbeddingResponse(vectors, status, (data.get("usage") or {}).get("prompt_tokens"))
+
+
+def chat_provider_class(api_url: str):
+    """Picks the adapter for a chat endpoint from its host/path."""
+    parsed = urlparse(api_url)
+    host = parsed.netloc.lower()
+    if "generativelanguage.googleapis.com" in host or ":generateContent" in parsed.path:
+        return GeminiChatProvider
+    if "anthropic.com" in host or parsed.path.rstrip("/").endswith("/v1/messages"):
+        return AnthropicChatProvider
+    if "deepseek.com" in host:
+        return DeepSeekChatProvider
+    return OpenAIChatProvider
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def _cached(cls, model_name, api_url, api_key):
+    key = (cls, model_name, api_url, api_key)
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = cls(api_url, api_key, model_name)
+        return _providers[key]
+
+
+def get_chat_provider(model_name: str, api_url: str, api_key: str) -> ChatProvider:
+    """Returns the shared adapter (and its warm connection pool) for a chat endpoint."""
+    return _cached(chat_provider_class(api_url), model_name, api_url, api_key)
+
+
+def get_embedding_provider(model_name: str, api_url: str, api_key: str) -> OpenAIEmbeddingProvider:
+    """Returns the shared adapter for an embeddings endpoint."""
+    return _cached(OpenAIEmbeddingProvider, model_name, api_url, api_key)
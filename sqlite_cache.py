@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Stay well under SQLite's bound-parameter limit.
+_MAX_PARAMS = 500
+# last_access updates from hits are written in batches: this many, or after this many seconds.
+_TOUCH_BATCH = 256
+_TOUCH_INTERVAL = 10.0
+# Eviction frees space down to this fraction of max_bytes, so a full cache doesn't evict on every put.
+_EVICT_TO = 0.9
+
+
+class SqliteLruCache:
+    """
+    Base for the on-disk (SQLite) caches: one table of values with a byte `size`,
+    `created_at` and `last_access` per row. Entries older than `max_age_seconds` are
+    treated as misses, and the least recently used ones are evicted once the stored
+    values exceed `max_bytes`. Safe to share between threads.
+
+    The stored byte total is kept in memory, so a put only scans the table when it
+    pushes the total over `max_bytes`; hits record their access time in memory and
+    write it back in batches.
+
+    Subclasses name the table, its key columns and its value column, and convert
+    values on the way in and out.
+    """
+
+    table = ""
+    key_columns = ()       # (name, SQL type) pairs forming the primary key
+    value_column = ("value", "BLOB")
+
+    def __init__(self, path: str, max_bytes: int, max_age_seconds: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._keys = [name for name, _ in self.key_columns]
+        self._value = self.value_column[0]
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = [f"{name} {sql_type} NOT NULL" for name, sql_type in (*self.key_columns, self.value_column)]
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            f" {', '.join(columns)},"
+            f" size INTEGER NOT NULL,"
+            f" created_at REAL NOT NULL,"
+            f" last_access REAL NOT NULL,"
+            f" PRIMARY KEY ({', '.join(self._keys)}))"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table}(last_access)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_created_at ON {self.table}(created_at)"
+        )
+        self._conn.commit()
+        self._match = " AND ".join(f"{name} = ?" for name in self._keys)
+        self._total_bytes = self._stored_bytes()
+        self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+
+    def _flush_touches(self) -> None:
+        """Writes the access times of recent hits (caller holds the lock and commits)."""
+        if self._touched:
+            self._conn.executemany(
+                f"UPDATE {self.table} SET last_access = ? WHERE {self._match}",
+                [(at, *key) for key, at in self._touched.items()],
+            )
+            self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _key_filter(self, count: int) -> str:
+        """WHERE clause matching `count` keys, bound as flat parameters."""
+        if len(self._keys) == 1:
+            return f"{self._keys[0]} IN ({','.join('?' * count)})"
+        row = "(" + ",".join("?" * len(self._keys)) + ")"
+        return f"({', '.join(self._keys)}) IN (VALUES {','.join([row] * count)})"
+
+    def _get_many(self, keys) -> dict:
+        """Returns {key tuple: stored value} for the keys that are stored and fresh."""
+        now = time.time()
+        keys = list(keys)
+        found = {}
+        step = max(1, _MAX_PARAMS // len(self._keys))
+        with self._lock:
+            for start in range(0, len(keys), step):
+                batch = keys[start:start + step]
+                rows = self._conn.execute(
+                    f"SELECT {', '.join(self._keys)}, {self._value}, created_at FROM {self.table}"
+                    f" WHERE {self._key_filter(len(batch))}",
+                    [part for key in batch for part in key],
+                ).fetchall()
+                for row in rows:
+                    if now - row[-1] <= self.max_age_seconds:
+                        found[tuple(row[:-2])] = row[-2]
+            for key in found:
+                self._touched[key] = now
+            if len(self._touched) >= _TOUCH_BATCH or (
+                self._touched and time.monotonic() - self._touched_at >= _TOUCH_INTERVAL
+            ):
+                self._flush_touches()
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def _put_many(self, items) -> None:
+        """Stores (key tuple, value, size) triples, then evicts expired and least recently used entries."""
+        now = time.time()
+        items = list(items)
+        rows = [(*key, value, size, now, now) for key, value, size in items]
+        if not rows:
+            return
+        columns = [*self._keys, self._value, "size", "created_at", "last_access"]
+        with self._lock:
+            # Replaced rows no longer count towards the total.
+            replaced = sum(self._size_of(key) for key, _, _ in items)
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(columns)})"
+                f" VALUES ({', '.join('?' * len(columns))})",
+                rows,
+            )
+            self._total_bytes += sum(size for _, _, size in items) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict(now)
+            self._conn.commit()
+
+    def _size_of(self, key) -> int:
+        row = self._conn.execute(f"SELECT size FROM {self.table} WHERE {self._match}", key).fetchone()
+        return row[0] if row else 0
+
+    def _discard(self, key) -> None:
+        with self._lock:
+            self._total_bytes -= self._size_of(key)
+            self._touched.pop(tuple(key), None)
+            self._conn.execute(f"DELETE FROM {self.table} WHERE {self._match}", key)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        """Drops expired entries, then least recently used ones until well under `max_bytes`."""
+        self._flush_touches()
+        self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.max_age_seconds,))
+        # Re-read the total here (rarely): other processes may share the file.
+        self._total_bytes = self._stored_bytes()
+        if self._total_bytes <= self.max_bytes:
+            return
+        excess = self._total_bytes - int(self.max_bytes * _EVICT_TO)
+        freed = 0
+        doomed = []
+        for *key, size in self._conn.execute(
+            f"SELECT {', '.join(self._keys)}, size FROM {self.table} ORDER BY last_access ASC"
+        ):
+            doomed.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE {self._match}", doomed)
+        self._total_bytes -= freed
+
+    def stats(self) -> dict:
+        """Hit/miss counters plus the current number and total size of entries."""
+        with self._lock:
+            entries, size = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def shared_cache(cls, path: str, max_bytes: int, max_age_seconds: float):
+    """
+    The process-wide `cls` instance for `path`. Reusing one instance keeps the counters
+    and the SQLite connection alive across Streamlit reruns.
+    """
+    with _instances_lock:
+        if (cls, path) not in _instances:
+            _instances[(cls, path)] = cls(path, max_bytes=max_bytes, max_age_seconds=max_age_seconds)
+        return _instances[(cls, path)]
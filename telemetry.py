@@ -0,0 +1,123 @@
+"""
+Per-call instrumentation for enrichment and embedding runs.
+
+Every provider call (including cache hits) becomes a CallRecord holding provider, model,
+latency, HTTP status, retries, token usage and, for chat calls, whether the answer
+parsed. RunTelemetry collects them thread-safely and summarizes throughput and latency
+percentiles for the live view and for the exported JSON/CSV run report.
+"""
+import csv
+import io
+import json
+import math
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
+from typing import Optional
+
+
+@dataclass
+class CallRecord:
+    kind: str                 # "chat" or "embedding"
+    provider: str
+    model: str
+    started_at: float         # Unix time
+    latency_s: float          # wall time including retries and backoff
+    status: Optional[int]     # last HTTP status, None for timeouts/connection errors/cache hits
+    retries: int = 0
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached: bool = False
+    items: int = 1            # prompts in the call (packed chunks / embedding inputs)
+    parse_ok: Optional[bool] = None
+    error: str = ""
+    first_token_s: Optional[float] = None  # streaming only: time to the first text delta
+    json_repair: str = ""     # chat only: "repaired" or "truncated" when the answer needed json_repair
+
+
+def percentile(values, q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100) of `values`, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class RunTelemetry:
+    """Thread-safe collector of CallRecords plus a row counter for throughput."""
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.started_at = time.time()
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self.records = []
+        self.rows_done = 0
+
+    def record(self, record: CallRecord) -> CallRecord:
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def add_rows(self, count: int) -> None:
+        with self._lock:
+            self.rows_done += count
+
+    def summary(self) -> dict:
+        with self._lock:
+            records = list(self.records)
+            rows_done = self.rows_done
+        elapsed = time.monotonic() - self._t0
+        live = [r for r in records if not r.cached]
+        latencies = [r.latency_s for r in live if not r.error]
+        parsed = [r for r in records if r.parse_ok is not None]
+        return {
+            "label": self.label,
+            "elapsed_s": round(elapsed, 3),
+            "rows_done": rows_done,
+            "rows_per_s": round(rows_done / elapsed, 3) if elapsed > 0 else 0.0,
+            "calls": len(records),
+            "cache_hits": len(records) - len(live),
+            "http_calls": len(live),
+            "failed_calls": sum(1 for r in live if r.error),
+            "retries": sum(r.retries for r in live),
+            "parse_failures": sum(1 for r in parsed if not r.parse_ok),
+            "repaired_answers": sum(1 for r in records if r.json_repair),
+            "truncated_answers": sum(1 for r in records if r.json_repair == "truncated"),
+            "prompt_tokens": sum(r.prompt_tokens or 0 for r in live),
+            "completion_tokens": sum(r.completion_tokens or 0 for r in live),
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p95_s": percentile(latencies, 95),
+            "latency_max_s": max(latencies) if latencies else None,
+            "first_token_p50_s": percentile([r.first_token_s for r in live if r.first_token_s is not None], 50),
+        }
+
+    def to_json(self) -> str:
+        with self._lock:
+            calls = [asdict(r) for r in self.records]
+        return json.dumps({"summary": self.summary(), "calls": calls}, indent=2)
+
+    def to_csv(self) -> str:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=[f.name for f in fields(CallRecord)])
+        writer.writeheader()
+        with self._lock:
+            for r in self.records:
+                writer.writerow(asdict(r))
+        return buf.getvalue()
+
+
+def format_summary(summary: dict) -> str:
+    """One-line human readable version of RunTelemetry.summary()."""
+    def _ms(value):
+        return "n/a" if value is None else f"{value * 1000:.0f} ms"
+
+    return (
+        f"{summary['rows_done']} rows in {summary['elapsed_s']:.0f}s ({summary['rows_per_s']:.2f} rows/s) · "
+        f"{summary['http_calls']} API calls, {summary['cache_hits']} cache hits · "
+        f"p50 {_ms(summary['latency_p50_s'])}, p95 {_ms(summary['latency_p95_s'])} · "
+        f"{summary['retries']} retries, {summary['failed_calls']} failed, {summary['parse_failures']} unparseable, "
+        f"{summary.get('repaired_answers', 0)} repaired ({summary.get('truncated_answers', 0)} cut off) · "
+        f"{summary['prompt_tokens']}+{summary['completion_tokens']} tokens"
+    )
@@ -0,0 +1,25 @@
+import hashlib
+import re
+import unicodedata
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate used for request sizing: ~4 ASCII characters per token (English
+    with OpenAI-style tokenizers), plus one token per non-ASCII character, since CJK,
+    Cyrillic and other scripts tokenize far more densely. It is an estimate, not a bound.
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def normalize_text(text: str) -> str:
+    """Unicode NFC with runs of whitespace collapsed to one space and the ends trimmed."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_hash(normalized_text: str) -> str:
+    """sha256 hex digest of an already normalized text."""
+    return hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()